@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 """
-This script uses FSL's functionality to extract the eigenvariate of all ROIs in a mask image.
-In this process, the mask image is split to yield one mask image for each ROI.
-Those are saved in a specified working directory.
+This script extracts the eigenvariate of all ROIs in a mask image, the same way
+FSL's fslmeants --eig does. Each run is loaded once and the eigenvariates of
+all ROIs are computed in the same process.
 """
 
-from mvpa2.datasets.mri import map2nifti, fmri_dataset
 import os
-from nipype.interfaces.fsl.utils import ImageMeants
 import csv
 import numpy as np
+from scipy import linalg
+from roi_extract import load_roi_block
 
 
 def getlabels(csvpath):
@@ -25,85 +25,65 @@ def getlabels(csvpath):
     return labelnames
 
 
-def split_mask(mask_image, workdir):
+def eigenvariate(timecourses):
     """
-    Split a mask with multiple ROIs into seperate files for each ROI.
-    Saves them in 'workdir/roi_masks'.
-    returns a list of paths for each produced mask file.
+    First eigenvariate of a (time x voxels) array, following the conventions
+    of fslmeants --eig: voxel time courses are demeaned, the eigenvector of
+    the largest eigenvalue of their (time x time) covariance is scaled by
+    the square root of that eigenvalue, and its sign is chosen such that it
+    correlates positively with the mean time course.
     """
 
-    ms = fmri_dataset(mask_image)
+    data = timecourses - timecourses.mean(axis=0)
+    cov = np.dot(data, data.T) / data.shape[1]
 
-    maskpath = os.path.join(workdir, 'roi_masks')
+    # eigh returns eigenvalues in ascending order
+    eigvals, eigvecs = linalg.eigh(cov)
+    eigv = eigvecs[:, -1] * np.sqrt(max(eigvals[-1], 0))
 
-    if not os.path.exists(maskpath):
-        os.makedirs(maskpath)
+    if np.dot(eigv, data.mean(axis=1)) < 0:
+        eigv = -eigv
+    return eigv
 
-    # list of paths for each roi mask
-    maskfiles = []
 
-    # save seperate mask for each roi to file in workdir
-    for roivalue in range(1, max(ms.samples[0]) + 1):
-        msc = ms.copy()
-        msc.samples[0][msc.samples[0] != roivalue] = False
-        image = map2nifti(msc)
-        maskfile = os.path.join(maskpath, 'roi{}_mask.nii.gz'.format(roivalue))
-        image.to_filename(maskfile)
-        maskfiles.append(maskfile)
-
-    return maskfiles
-
-
-def extract_eigenv_roi(bold_image, mask, csvpath, sub, run):
+def extract_eigenvariates(bold_image, mask_image):
     """
-    Use fsl.ImageMeants to extract eigenvariate
+    Load a run once and compute the first eigenvariate of every roi
+    in the mask image (roi values 1 to max).
+    Returns a (time x rois) array.
     """
 
-    if not os.path.exists(csvpath):
-        os.makedirs(csvpath)
+    samples, roi = load_roi_block(bold_image, mask_image, dtype=float)
 
-    extract_eigv = ImageMeants(in_file=bold_image,
-                               terminal_output='file', eig=True,
-                               mask=mask,
-                               out_file=os.path.join(
-                                   csvpath, '{}_{}_{}.csv'.format(sub, run, mask.replace('_mask.nii.gz', '')[-4:])))
-    extract_eigv.run()
+    eigvs = np.empty((samples.shape[0], int(roi.max())))
+    for roivalue in range(1, eigvs.shape[1] + 1):
+        roi_samples = samples[:, roi == roivalue]
+        if roi_samples.shape[1] == 0:
+            eigvs[:, roivalue - 1] = np.nan
+        else:
+            eigvs[:, roivalue - 1] = eigenvariate(roi_samples)
+    return eigvs
 
 
-def concat_rois(csvpath, outfile):
+def write_rois_csv(eigvs, outfile,
+                   roi_csv='/data/famface/openfmri/github/notebooks/roi_coord.csv'):
     """
-    concatinate the csv files generated by fsl for each roi into one csv
+    Write the eigenvariates of all rois into one csv
+    (roi labels as header, time points as rows).
     """
 
-    # path to csv with ROI labels hardcoded for now
-    roi_csv = '/data/famface/openfmri/github/notebooks/roi_coord.csv'
     labels = getlabels(roi_csv)
-    csvs = os.listdir(csvpath)
-    out = []
-
-    for cs in csvs:
 
-        with open(os.path.join(csvpath, cs)) as f:
-            reader = csv.reader(f)
-            temp = []
-            for row in reader:
-                temp.append(float(row[0]))
-            np_temp = np.array(temp)
-        out.append(np_temp)
+    with open(outfile, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(labels)
+        writer.writerows(eigvs.tolist())
 
-        with open(outfile, 'wb') as f:
-            writer = csv.writer(f)
-            writer.writerow(labels)
-            # writer.writerow(range(1, len(out) + 1))
-            for idx in range(len(np_temp)):
-                row = [element[idx] for element in out]
-                writer.writerow(row)
 
-
-def extract_eigenvariate_famfaces(datadir, workdir, sub, run, maskfiles,
+def extract_eigenvariate_famfaces(datadir, workdir, sub, run, mask,
                                   ecpreproc=False):
     """
-    execute split_mask, extract_eigenv_roi, and concat_rois
+    execute extract_eigenvariates and write_rois_csv
     for given run of given subject.
     """
 
@@ -119,41 +99,45 @@ def extract_eigenvariate_famfaces(datadir, workdir, sub, run, maskfiles,
     if not os.path.exists(csvpath):
         os.makedirs(csvpath)
 
-    # extract eigenvariate for each roi mask
-    for mask in maskfiles:
-        extract_eigenv_roi(bold_image=bold_image, mask=mask,
-                           csvpath=csvpath, sub=sub, run=run)
-
-    # concatinate all roi specific csvs into one csv
-    outfile_allrois = os.path.join(workdir, 'csv', sub, run, '{}_{}_all.csv'.format(sub, run))
-    concat_rois(csvpath=csvpath, outfile=outfile_allrois)
+    # extract eigenvariate for all rois and write them into one csv
+    eigvs = extract_eigenvariates(bold_image, mask)
+    outfile_allrois = os.path.join(csvpath, '{}_{}_all.csv'.format(sub, run))
+    write_rois_csv(eigvs, outfile_allrois)
 
 
 if __name__ == '__main__':
 
-    # get subjectID from command line argument
+    # get subjectID(s) from command line argument
+    import argparse
     import sys
-    subj = sys.argv[1]
+    from scheduler import WorkItem, add_scheduler_arguments, expand_subjects, run_work_items
+
+    parser = argparse.ArgumentParser(description='Extract roi eigenvariates of all runs.')
+    parser.add_argument('subj',
+                        help="subject(s), e.g. 'sub001', 'sub001,sub004' or 'sub001-sub033'")
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
 
     # preprocessed data set in mni space
     # dat = '/data/famface/openfmri/oli/results_with_main_effect/l1ants_fwhm6_hp60_derivs_frac0.1/model001/task001'
     # specifically for EC preprocessed data
     dat = '/data/famface/openfmri/oli/results/ec_preproc/'
 
-    # working directory stores temporary csv files
+    # working directory stores the csv files
     work = os.path.join('/data', 'famface', 'openfmri', 'oli', 'results', 'extract_eigenv_ecp', 'workdir')
     # path to mask image
     mask = '/data/famface/openfmri/scripts/notebooks/rois_manual_r5_20170222_nooverlap.nii.gz'
 
-    # split mask image and save in work directory
-    if not os.path.exists(os.path.join(work, 'roi_masks')):
-        maskfiles = split_mask(mask, work)
-        print('created split mask images')
-    else:
-        print('split mask images did already exist! (which is good).')
-        maskfiles = [os.path.join(work, 'roi_masks', 'roi%i_mask.nii.gz' % roinum)
-                     for roinum in range(1, 31)]
-
-    for run in ['run%03d' % i for i in range(1, 12)]:
-        extract_eigenvariate_famfaces(dat, work, subj, run, maskfiles, ecpreproc=True)
-        print('finished %s %s' % (subj, run))
+    # one work item per subject and run
+    items = []
+    for subj in expand_subjects(args.subj):
+        for run in ['run%03d' % i for i in range(1, 12)]:
+            items.append(WorkItem(
+                name='%s %s' % (subj, run),
+                func=extract_eigenvariate_famfaces,
+                kwargs=dict(datadir=dat, workdir=work, sub=subj, run=run, mask=mask, ecpreproc=True),
+                outputs=[os.path.join(work, 'csv', subj, run, '{}_{}_all.csv'.format(subj, run))]))
+
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+    sys.exit(1 if failed else 0)
@@ -4,10 +4,16 @@ from mvpa2.datasets.mri import fmri_dataset
 from nipype.interfaces import fsl, ants
 from nipype.interfaces.fsl.utils import ConvertXFM
 from nipype.interfaces.c3 import C3dAffineTool
+import nibabel as nb
 import numpy as np
 import csv
+import hashlib
 import os
+import shutil
+import tempfile
 from os.path import join
+from roi_extract import load_roi_block, roi_bounding_box, roi_means
+from transform_lut import file_sha1, lut_mask2pe
 
 """
 Tools to extract mean timeseries or beta values from 4D or 3D statistical images
@@ -193,6 +199,60 @@ def mask2pe_ants(mnimask, anat, pe, mni2anat_hd5, affine_matrix, workdir):
     return outfile
 
 
+def cached_mask2pe_ants(mnimask, anat, pe, mni2anat_hd5, affine_matrix, cache_dir, use_lut=True):
+    """
+    Like mask2pe_ants, but the projected mask is stored in a subdirectory of
+    cache_dir named after a hash of the inputs (content of mask, anatomical
+    image and transforms, and the grid of the reference stats map). All stats
+    maps of a subject share the same grid, so the projection runs only once
+    per subject and is reused afterwards.
+
+    Each projection is computed in its own temporary directory, which is then
+    renamed to the cache entry. So concurrent jobs never write into the same
+    directory, and an interrupted job doesn't leave a broken entry behind.
+
+    If use_lut, the projection is done with a voxel lookup table (see
+    transform_lut.py, also cached in cache_dir), which is shared by all masks
+    on the same mni grid.
+    """
+
+    # the reference image only contributes its grid to the output
+    ref = nb.load(pe)
+    key = hashlib.sha1()
+    for path in (mnimask, anat, mni2anat_hd5, affine_matrix):
+        key.update(file_sha1(path).encode('utf-8'))
+    key.update(repr(ref.shape[:3]).encode('utf-8'))
+    key.update(np.asarray(ref.affine, dtype=np.float64).tobytes())
+
+    entry = join(cache_dir, 'mask2pe_%s' % key.hexdigest()[:16])
+    outfile = join(entry, 'mask2pe.nii.gz')
+    if os.path.exists(outfile):
+        return outfile
+
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+
+    tmpdir = tempfile.mkdtemp(prefix='tmp_mask2pe_', dir=cache_dir)
+    try:
+        if use_lut:
+            lut_mask2pe(mnimask, anat, pe, mni2anat_hd5, affine_matrix, tmpdir, cache_dir)
+        else:
+            mask2pe_ants(mnimask, anat, pe, mni2anat_hd5, affine_matrix, tmpdir)
+        os.rename(tmpdir, entry)
+    except OSError:
+        # another job finished the same projection first, use theirs
+        if not os.path.exists(outfile):
+            raise
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir)
+
+    return outfile
+
+
 def pe2mni_ants(pe, mni2anat_hd5, affine_matrix, workdir,
                 standard='/usr/share/fsl/5.0/data/standard/MNI152_T1_2mm_brain.nii.gz'):
     """
@@ -225,22 +285,11 @@ def extract_mean_timeseries(bold, mask):
     """
     extract mean time series of rois given pymvpa datasets
     for a mask and a bold time-series. Used for TETRAD.
+    Returns a (time points x rois) array.
     """
 
-    roi_timeseries = []
-
     # select first sample of mask dataset
-    roi = mask.samples[0]
-
-    # make a copy of bold dataset for safety
-    bold_cp = bold.copy()
-
-    for roi_value in range(1, int(max(roi)) + 1):
-        roi_timeseries.append(
-            [np.mean(sample[roi == roi_value]) for sample in bold_cp.samples]
-        )
-
-    return roi_timeseries
+    return roi_means(bold.samples, mask.samples[0])
 
 
 def extract_mean_3d(bold, mask):
@@ -250,22 +299,12 @@ def extract_mean_3d(bold, mask):
     parameter or contrast estimates.
     """
 
-    roi_timeseries = []
-
     # select first sample of mask dataset
     assert len(mask) == 1
-    roi = mask.samples[0]
-
-    # make a copy of bold dataset for safety
     assert len(bold) == 1
-    bold_cp = bold.copy()
-
-    bold_cp_sample = bold_cp.samples[0]
 
-    for roi_value in range(1, int(max(roi)) + 1):
-        # append mean of values in beta map that correspond to roi value index in roi mask
-        roi_timeseries.append(np.mean(bold_cp_sample[roi == roi_value]))
-    return roi_timeseries
+    # mean of values in beta map that correspond to roi value index in roi mask
+    return roi_means(bold.samples, mask.samples[0])[0].tolist()
 
 
 def getlabels(csvpath):
@@ -283,17 +322,18 @@ def getlabels(csvpath):
 
 def transpose_and_write(roi_timeseries, outfile):
     """
-    Write roi_timeseries to csv file (with roi-indices as header) with rois as
-    columns and time points as rows.
+    Write roi_timeseries (time points x rois, as returned by
+    extract_mean_timeseries) to csv file (with roi-indices as header) with rois
+    as columns and time points as rows.
     For use in TETRAD.
     """
-    transposed = map(list, zip(*roi_timeseries))
-    # give it a header
-    transposed.insert(0, range(1, len(roi_timeseries) + 1))
+    roi_timeseries = np.asarray(roi_timeseries)
 
     with open(outfile, 'w') as f:
         wr = csv.writer(f)
-        wr.writerows(transposed)
+        # give it a header
+        wr.writerow(range(1, roi_timeseries.shape[1] + 1))
+        wr.writerows(roi_timeseries.tolist())
 
 
 def extract_runs_famface_mnimask(base_dir, out_dir, mnimask, sub_id):
@@ -310,17 +350,21 @@ def extract_runs_famface_mnimask(base_dir, out_dir, mnimask, sub_id):
         outfile = os.path.join(out_dir, '{}_{}_roimean.csv'.format(sub_id, run))
 
         print('extracting run {}'.format(run))
-        timeseries = extract_timeseries(infile, mnimask)
+        timeseries = extract_mean_timeseries(fmri_dataset(infile), fmri_dataset(mnimask))
         print('writing csv for run {}'.format(run))
         transpose_and_write(timeseries, outfile)
         print('run {} extracted!'.format(run))
 
 
-def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template, outfilename, beta_filename):
+def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template, outfilename, beta_filename,
+                               lazy=False, cache_dir=None, mask_cache_dir=None):
     """
-    Project the mni mask into subject space. Extract the mean
+    Project the mni mask into subject space (cached in mask_cache_dir, by
+    default out_dir/masktrans, see cached_mask2pe_ants). Extract the mean
     parameter estimate (zstat, pe, cope, varcope) for each roi and run.
     For all runs of one subject (submit multiple subjects in parallel via PBS/Condor).
+    If lazy, only the voxels within the rois' bounding box are read
+    (see load_roi_block).
     """
 
     # this list will later be written to a csv file.
@@ -330,17 +374,20 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template
     runs = ['_modelestimate%d' % i for i in range(11)]
 
     # create output directory
-    if not os.path.exists(out_dir):
+    # (other stats types of this subject might be creating it at the same time)
+    try:
         os.makedirs(out_dir)
+    except OSError:
+        if not os.path.isdir(out_dir):
+            raise
 
     """
     project mask into subject space
     """
 
-    # create workdir to save transform files
-    workdir = join(out_dir, 'masktrans')
-    if not os.path.exists(workdir):
-        os.makedirs(workdir)
+    # projected masks are cached here, one subdirectory per set of inputs
+    if mask_cache_dir is None:
+        mask_cache_dir = join(out_dir, 'masktrans')
 
     # path to hd5 file and affine transformation matrix
     mni2anat_hd5 = join(base_dir, 'registration', subdir_template, 'antsRegister', 'output_InverseComposite.h5')
@@ -350,9 +397,11 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template
     pe_template = join(base_dir, 'modelestimate', subdir_template, 'modelestimate',
                               'mapflow', '_modelestimate0', 'results', beta_filename)
 
-    # do transformation, load result in pymvpa
-    mask_subspace_path = mask2pe_ants(mnimask, anat, pe_template, mni2anat_hd5, affine_matrix, workdir)
-    ms = fmri_dataset(mask_subspace_path)
+    # do transformation (or reuse a cached one), load result in pymvpa
+    mask_subspace_path = cached_mask2pe_ants(mnimask, anat, pe_template, mni2anat_hd5, affine_matrix,
+                                             mask_cache_dir)
+    if not lazy:
+        ms = fmri_dataset(mask_subspace_path)
 
     """
     extract mean parameter estimate for each run
@@ -363,11 +412,16 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template
         pe_file = join(base_dir, 'modelestimate', subdir_template, 'modelestimate',
                              'mapflow', run, 'results', beta_filename)
 
-        # load stats map in pymvpa
-        stats_map = fmri_dataset(pe_file)
+        if lazy:
+            # only read the roi voxels of the stats map
+            samples, roi = load_roi_block(pe_file, mask_subspace_path, cache_dir)
+            run_betas = roi_means(samples, roi)[0].tolist()
+        else:
+            # load stats map in pymvpa
+            stats_map = fmri_dataset(pe_file)
 
-        # extract mean parameter estimates
-        run_betas = extract_mean_3d(stats_map, ms)
+            # extract mean parameter estimates
+            run_betas = extract_mean_3d(stats_map, ms)
         betas.append(run_betas)
 
     # write to a csv file
@@ -378,18 +432,32 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, anat, subdir_template
             writer.writerow(b)
 
 
-if __name__ == '__main__':
+# regressors and contrasts of the 1st level model (name, number of the stats file)
+contrasts = [
+    # simple regressors
+    ('familiar', 1),
+    ('unfamiliar', 2),
+    # contrasts
+    ('famvsunfam', 3),
+    ('unfamvsfam', 4),
+]
 
-    # pass arguments to this script
-    import sys
 
-    sub_id = sys.argv[1]
-    base_dir = sys.argv[2]
-    out_base_dir = sys.argv[3]
-    mnimask = sys.argv[4]
+def subject_conds(stats):
+    """
+    dict with regressors and contrasts to extract for a kind of parameter
+    estimate (output csv name without subject: stats file name)
+    """
+    return dict(('%s_mean_%s' % (name, stats), '%s%d.nii.gz' % (stats, number))
+                for name, number in contrasts)
 
-    # path to base directory (working directory from nipype 1st lvl analysis)
-    #base_dir = '/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/'
+
+def extract_subject_betas(sub_id, base_dir, out_base_dir, mnimask, lazy=False,
+                          stats_types=('tstat', 'zstat', 'cope', 'varcope')):
+    """
+    Extract the mean parameter estimates of all regressors, contrasts and
+    kinds of parameter estimates for one subject.
+    """
 
     # create one output directory for each subject
     out_dir = join(out_base_dir, sub_id)
@@ -401,20 +469,123 @@ if __name__ == '__main__':
     anat_brain = join(base_dir, 'registration', subdir_template, 'stripper', 'highres001_brain.nii.gz')
 
     # iterate over different kinds of parameter estimates
-    for stats in ['tstat', 'zstat', 'cope', 'varcope']:
-
-        # dict with regressors and contrasts to extract
-        conds = {
-            # simple regressors
-            'familiar_mean_%s' % stats: '%s1.nii.gz' % stats,
-            'unfamiliar_mean_%s' % stats: '%s2.nii.gz' % stats,
-            # contrasts
-            'famvsunfam_mean_%s' % stats: '%s3.nii.gz' % stats,
-            'unfamvsfam_mean_%s' % stats: '%s4.nii.gz' % stats,
-        }
+    for stats in stats_types:
+        conds = subject_conds(stats)
 
         # extract betas
         for cond in conds.keys():
             extract_runs_famface_betas(base_dir, out_dir, mnimask, anat_brain, subdir_template,
                                        outfilename='%s_%s.csv' % (cond, sub_id),
-                                       beta_filename=conds[cond])
+                                       beta_filename=conds[cond], lazy=lazy)
+
+
+def extract_subject_betas_long(sub_id, base_dir, out_base_dir, mnimask,
+                               stats_types=('tstat', 'zstat', 'cope', 'varcope'), nruns=11):
+    """
+    Batch version of extract_subject_betas. Project the mask once, read every
+    stats map of the subject exactly once (only the voxels within the rois'
+    bounding box), stack them into one (maps x roi voxels) array and compute
+    all roi means in a single reduction.
+    Writes one long-format csv (subject, run, stat, contrast, roi, value)
+    to out_base_dir/sub_id/<sub_id>_betas_long.csv and returns its path.
+    """
+
+    out_dir = join(out_base_dir, sub_id)
+    subdir_template = '_model_id_1_subject_id_%s_task_id_1' % sub_id
+    anat_brain = join(base_dir, 'registration', subdir_template, 'stripper', 'highres001_brain.nii.gz')
+    mni2anat_hd5 = join(base_dir, 'registration', subdir_template, 'antsRegister', 'output_InverseComposite.h5')
+    affine_matrix = join(base_dir, 'registration', subdir_template, 'mean2anatbbr', 'median_flirt.mat')
+
+    def stats_file(run, stats, number):
+        return join(base_dir, 'modelestimate', subdir_template, 'modelestimate',
+                    'mapflow', '_modelestimate%d' % run, 'results', '%s%d.nii.gz' % (stats, number))
+
+    """
+    project mask into subject space (all stats maps share the same grid)
+    """
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        if not os.path.isdir(out_dir):
+            raise
+    mask_subspace_path = cached_mask2pe_ants(mnimask, anat_brain, stats_file(0, stats_types[0], 1),
+                                             mni2anat_hd5, affine_matrix, join(out_dir, 'masktrans'))
+
+    bbox, roi, inroi = roi_bounding_box(np.asarray(nb.load(mask_subspace_path).dataobj))
+
+    """
+    read each stats map once and reduce all of them at the same time
+    """
+
+    keys = [(run, stats, name, number)
+            for run in range(nruns) for stats in stats_types for name, number in contrasts]
+    samples = np.empty((len(keys), np.count_nonzero(inroi)), dtype=np.float32)
+    for i, (run, stats, name, number) in enumerate(keys):
+        samples[i] = np.asarray(nb.load(stats_file(run, stats, number)).dataobj[bbox])[inroi]
+    means = roi_means(samples, roi[inroi])
+
+    """
+    write long-format table
+    """
+
+    outfile = join(out_dir, '%s_betas_long.csv' % sub_id)
+    with open(outfile, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['subject', 'run', 'stat', 'contrast', 'roi', 'value'])
+        for (run, stats, name, number), row in zip(keys, means):
+            for roi_idx, value in enumerate(row, 1):
+                writer.writerow([sub_id, run + 1, stats, name, roi_idx, repr(float(value))])
+
+    return outfile
+
+
+if __name__ == '__main__':
+
+    # pass arguments to this script
+    import argparse
+    import sys
+    from scheduler import WorkItem, add_scheduler_arguments, expand_subjects, run_work_items
+
+    parser = argparse.ArgumentParser(description='Extract mean parameter estimates within rois.')
+    parser.add_argument('sub_id',
+                        help="subject(s), e.g. 'sub001', 'sub001,sub004' or 'sub001-sub033'")
+    # path to base directory (working directory from nipype 1st lvl analysis)
+    # e.g. '/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/'
+    parser.add_argument('base_dir')
+    parser.add_argument('out_base_dir')
+    parser.add_argument('mnimask')
+    # pass 'lazy' as fifth argument to only read the roi voxels of each stats map
+    parser.add_argument('lazy', nargs='?', default='')
+    parser.add_argument('--long', action='store_true',
+                        help='read every stats map once and write one long-format csv per subject '
+                             '(subject, run, stat, contrast, roi, value) instead of one csv per '
+                             'regressor and kind of parameter estimate')
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+
+    items = []
+    for sub_id in expand_subjects(args.sub_id):
+        if args.long:
+            # one work item per subject, reading all of the subject's stats maps
+            items.append(WorkItem(
+                name=sub_id, func=extract_subject_betas_long,
+                kwargs=dict(sub_id=sub_id, base_dir=args.base_dir, out_base_dir=args.out_base_dir,
+                            mnimask=args.mnimask),
+                outputs=[join(args.out_base_dir, sub_id, '%s_betas_long.csv' % sub_id)]))
+            continue
+
+        # one work item per subject for all kinds of parameter estimates, so
+        # that the mask is projected once (by the first of them) and the others
+        # reuse the cached projection, also with parallel workers.
+        outputs = [join(args.out_base_dir, sub_id, '%s_%s.csv' % (cond, sub_id))
+                   for stats in ['tstat', 'zstat', 'cope', 'varcope'] for cond in subject_conds(stats)]
+        items.append(WorkItem(
+            name=sub_id, func=extract_subject_betas,
+            kwargs=dict(sub_id=sub_id, base_dir=args.base_dir, out_base_dir=args.out_base_dir,
+                        mnimask=args.mnimask, lazy=args.lazy == 'lazy'),
+            outputs=outputs))
+
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+    sys.exit(1 if failed else 0)
@@ -86,14 +86,14 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, subdir_template, stat
         # list of directory names for each run
         runs = ['_modelestimate%d' % i for i in range(11)]
 
-        # create output directory
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-
-        # create workdir
+        # create output directory and workdir
+        # (other stats types of this subject might be creating them at the same time)
         workdir = join(out_dir, 'masktrans')
-        if not os.path.exists(workdir):
+        try:
             os.makedirs(workdir)
+        except OSError:
+            if not os.path.isdir(workdir):
+                raise
 
         # path to hd5 file and affine transformation matrix
         mni2anat_hd5 = join(base_dir, 'registration', subdir_template, 'antsRegister', 'output_Composite.h5')
@@ -129,43 +129,72 @@ def extract_runs_famface_betas(base_dir, out_dir, mnimask, subdir_template, stat
                 writer.writerow(b)
 
 
-if __name__ == '__main__':
-
-    # pass arguments to this script
-    import sys
+def extract_subject_stats(sub_id, out_base_dir, maskpath, stats,
+                          base_dir='/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/'):
+    """
+    Extract the mean parameter estimates of all regressors and contrasts
+    for one kind of parameter estimate (stats) of one subject.
+    base_dir is the working directory from nipype 1st lvl analysis.
+    """
 
-    sub_id = sys.argv[1]
-    out_base_dir = sys.argv[2]
-    maskpath = sys.argv[3]
     mnimask = fmri_dataset(maskpath)
 
-    # path to base directory (working directory from nipype 1st lvl analysis)
-    base_dir = '/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/'
-
     # create one output directory for each subject
     out_dir = join(out_base_dir, sub_id)
 
     # make this part of the path names a variable. for ease of use and aesthetics (since it repeats a lot).
     subdir_template = '_model_id_1_subject_id_%s_task_id_1' % sub_id
 
-    # iterate over different kinds of parameter estimates
-    for stats in ['tstat', 'zstat', 'cope', 'varcope']:
+    # extract betas
+    conds = subject_conds(stats)
+    for cond in conds.keys():
 
-        # dict with regressors and contrasts to extract
-        conds = {
-            # simple regressors
-            'familiar_mean_%s' % stats: '%s1.nii.gz' % stats,
-            'unfamiliar_mean_%s' % stats: '%s2.nii.gz' % stats,
-            # contrasts
-            'famvsunfam_mean_%s' % stats: '%s3.nii.gz' % stats,
-            'unfamvsfam_mean_%s' % stats: '%s4.nii.gz' % stats,
-        }
+        extract_runs_famface_betas(base_dir, out_dir, mnimask, subdir_template, stats,
+                                   csvfilename='%s_%s.csv' % (cond, sub_id),
+                                   beta_filename=conds[cond])
 
-        # extract betas
-        for cond in conds.keys():
 
-            extract_runs_famface_betas(base_dir, out_dir, mnimask, subdir_template, stats,
-                                       csvfilename='%s_%s.csv' % (cond, sub_id),
-                                       beta_filename=conds[cond])
+def subject_conds(stats):
+    """
+    dict with regressors and contrasts to extract for a kind of parameter
+    estimate (output csv name without subject: stats file name)
+    """
+    return {
+        # simple regressors
+        'familiar_mean_%s' % stats: '%s1.nii.gz' % stats,
+        'unfamiliar_mean_%s' % stats: '%s2.nii.gz' % stats,
+        # contrasts
+        'famvsunfam_mean_%s' % stats: '%s3.nii.gz' % stats,
+        'unfamvsfam_mean_%s' % stats: '%s4.nii.gz' % stats,
+    }
 
-#base_dir, out_dir, mnimask, subdir_template, stats_type, csvfilename, beta_filename)
+
+if __name__ == '__main__':
+
+    # pass arguments to this script
+    import argparse
+    import sys
+    from scheduler import WorkItem, add_scheduler_arguments, expand_subjects, run_work_items
+
+    parser = argparse.ArgumentParser(description='Extract mean parameter estimates in mni space.')
+    parser.add_argument('sub_id',
+                        help="subject(s), e.g. 'sub001', 'sub001,sub004' or 'sub001-sub033'")
+    parser.add_argument('out_base_dir')
+    parser.add_argument('maskpath')
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+
+    # one work item per subject and kind of parameter estimate
+    items = []
+    for sub_id in expand_subjects(args.sub_id):
+        for stats in ['tstat', 'zstat', 'cope', 'varcope']:
+            items.append(WorkItem(
+                name='%s %s' % (sub_id, stats), func=extract_subject_stats,
+                kwargs=dict(sub_id=sub_id, out_base_dir=args.out_base_dir,
+                            maskpath=args.maskpath, stats=stats),
+                outputs=[join(args.out_base_dir, sub_id, '%s_%s.csv' % (cond, sub_id))
+                         for cond in subject_conds(stats)]))
+
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+    sys.exit(1 if failed else 0)
@@ -45,6 +45,10 @@ import nipype.interfaces.freesurfer as fs
 
 # import our custom 2nd lvl workflow
 from run_flow import create_run_flow
+from registration_store import cached_ants_node, cached_flirt_node
+from workflow_profile import NodeProfiler, enable_resource_monitor
+from node_resources import annotate_resources, load_node_resources
+from scheduler import expand_subjects
 import numpy as np
 
 version = 0
@@ -72,26 +76,61 @@ def flatten_list(in1):
         raise TypeError("input is neither list nor string. don't know what to do with it!")
 
 
-def median(in_files):
+def median(in_files, slab_size=8, n_threads=4):
     """Computes an average of the median of each realigned timeseries
 
+    To keep the memory footprint small, the median is computed in slabs of
+    slab_size slices (along z) from a memory map of each run, i.e. without
+    loading a full 4D time series. Gzipped runs are decompressed to a
+    temporary file first (memory mapping needs uncompressed data). Runs are
+    processed in n_threads parallel threads.
+
     Parameters
     ----------
     in_files: one or more realigned Nifti 4D time series
+    slab_size: number of slices processed at once
+    n_threads: number of runs processed in parallel
 
     Returns
     -------
     out_file: a 3D Nifti file
     """
+    import gzip
+    import shutil
+    import tempfile
+    from multiprocessing.pool import ThreadPool
+
+    def run_median(filename):
+        tmpfile = None
+        if filename.endswith('.gz'):
+            # uncompressed copy in the node's directory
+            fd, tmpfile = tempfile.mkstemp(suffix='.nii', dir=os.getcwd())
+            with gzip.open(filename, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+        try:
+            img = nb.load(tmpfile or filename, mmap=True)
+            data = np.empty(img.shape[:3])
+            for z in range(0, img.shape[2], slab_size):
+                data[:, :, z:z + slab_size] = np.median(img.dataobj[:, :, z:z + slab_size, :], axis=3)
+            del img
+        finally:
+            if tmpfile is not None:
+                os.remove(tmpfile)
+        return data
+
+    in_files = filename_to_list(in_files)
+    pool = ThreadPool(max(1, min(n_threads, len(in_files))))
     average = None
-    for idx, filename in enumerate(filename_to_list(in_files)):
-        img = nb.load(filename)
-        data = np.median(img.get_data(), axis=3)
+    for data in pool.map(run_median, in_files):
         if average is None:
             average = data
         else:
-            average = average + data
-    median_img = nb.Nifti1Image(average / float(idx + 1),
+            average += data
+    pool.close()
+    pool.join()
+
+    img = nb.load(in_files[0])
+    median_img = nb.Nifti1Image(average / float(len(in_files)),
                                 img.get_affine(), img.get_header())
     filename = os.path.join(os.getcwd(), 'median.nii.gz')
     median_img.to_filename(filename)
@@ -153,12 +192,14 @@ def build_filter1(motion_params, comp_norm, outliers, detrend_poly=None):
 
 
 
-def create_reg_workflow(name='registration'):
+def create_reg_workflow(name='registration', store_dir=None):
     """Create a FEAT preprocessing workflow
 
     Parameters
     ----------
         name : name of workflow (default: 'registration')
+        store_dir : registration result store shared by the pipeline variants
+            (see registration_store.py), or None to always register
 
     Inputs:
         inputspec.source_files : files (filename or list of filenames to register)
@@ -234,6 +275,8 @@ def create_reg_workflow(name='registration'):
     mean2anatbbr.inputs.cost = 'bbr'
     mean2anatbbr.inputs.schedule = os.path.join(os.getenv('FSLDIR'),
                                                 'etc/flirtsch/bbr.sch')
+    if store_dir:
+        mean2anatbbr = cached_flirt_node(mean2anatbbr, store_dir)
     register.connect(inputnode, 'mean_image', mean2anatbbr, 'in_file')
     register.connect(binarize, 'out_file', mean2anatbbr, 'wm_seg')
     register.connect(inputnode, 'anatomical_image', mean2anatbbr, 'reference')
@@ -296,6 +339,8 @@ def create_reg_workflow(name='registration'):
     reg.inputs.num_threads = 4
     reg.plugin_args = {'qsub_args': '-pe orte 4',
                        'sbatch_args': '--mem=6G -c 4'}
+    if store_dir:
+        reg = cached_ants_node(reg, store_dir)
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode, 'target_image_brain', reg, 'fixed_image')
 
@@ -764,7 +809,8 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                              task_id=None, output_dir=None, subj_prefix='*',
                              hpcutoff=120., use_derivatives=True,
                              fwhm=6.0, subjects_dir=None, target=None,
-                             num_components=5,
+                             num_components=5, compcor_svd='full', reg_store=None,
+                             resources_file=None,
                              mcrefvol='first', refrun=0):
 
     """Analyzes an open fmri dataset
@@ -777,6 +823,13 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     work_dir : str
         Nipype working directory (defaults to cwd)
 
+    reg_store : str
+        Registration result store shared by the pipeline variants (optional)
+
+    resources_file : str
+        json file with n_procs and mem_gb of the heavy nodes (default
+        node_resources.json)
+
     mcrefvol : str
         Which volume of the FIRST RUN to use as reference for motion correction.
     """
@@ -792,7 +845,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     if subjects_dir:
         registration = create_fs_reg_workflow()
     else:
-        registration = create_reg_workflow()
+        registration = create_reg_workflow(store_dir=reg_store)
 
     """
     Remove the plotting connection so that plot iterables don't propagate
@@ -818,6 +871,9 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                 ('model_id', [model_id]),
                                 ('task_id', task_id)]
     else:
+        missing = [subj for subj in subject if subj not in subjects]
+        if missing:
+            raise ValueError('subjects not found in %s: %s' % (data_dir, ', '.join(missing)))
         infosource.iterables = [('subject_id',
                                  [subjects[subjects.index(subj)] for subj in subject]),
                                 ('model_id', [model_id]),
@@ -1005,7 +1061,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     wf.connect(preproc, "outputspec.realigned_files", tsnr, "in_file")
 
     # Compute the median image across runs
-    calc_median = Node(Function(input_names=['in_files'],
+    calc_median = Node(Function(input_names=['in_files', 'slab_size', 'n_threads'],
                                 output_names=['median_file'],
                                 function=median,
                                 imports=imports),
@@ -1148,7 +1204,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
 
 
     def extract_noise_components(realigned_file, mask_file, num_components=5,
-                                 extra_regressors=None):
+                                 extra_regressors=None, svd_method='full', slab_size=8):
         """Derive components most reflective of physiological noise
 
         Parameters
@@ -1157,36 +1213,82 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
         mask_file: a 3D Nifti file containing white matter + ventricular masks
         num_components: number of components to use for noise decomposition
         extra_regressors: additional regressors to add
+        svd_method: 'full' computes the complete svd of the voxel time courses.
+            'gram' only computes the left singular vectors, as eigenvectors of
+            the (time x time) gram matrix, which is accumulated over slabs of
+            slab_size slices of a memory map of the series (without loading
+            the whole 4D file).
+        slab_size: number of slices read at once ('gram' only)
 
         Returns
         -------
         components_file: a text file containing the noise components
         """
         from scipy.linalg.decomp_svd import svd
+        from scipy.linalg import eigh
         import numpy as np
         import nibabel as nb
         import os
+        import gzip
+        import shutil
+        import tempfile
         imgseries = nb.load(realigned_file)
-        components = None
-        for filename in filename_to_list(mask_file):
-            mask = nb.load(filename).get_data()
-            if len(np.nonzero(mask > 0)[0]) == 0:
-                continue
-            voxel_timecourses = imgseries.get_data()[mask > 0]
-            voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
-            # remove mean and normalize by variance
-            # voxel_timecourses.shape == [nvoxels, time]
-            X = voxel_timecourses.T
-            stdX = np.std(X, axis=0)
-            stdX[stdX == 0] = 1.
-            stdX[np.isnan(stdX)] = 1.
-            stdX[np.isinf(stdX)] = 1.
-            X = (X - np.mean(X, axis=0)) / stdX
-            u, _, _ = svd(X, full_matrices=False)
-            if components is None:
-                components = u[:, :num_components]
-            else:
-                components = np.hstack((components, u[:, :num_components]))
+        tmpfile = None
+        try:
+            if svd_method == 'gram' and realigned_file.endswith('.gz'):
+                # memory mapping needs uncompressed data (and slicing the .nii.gz
+                # would decompress it from the start for every slab)
+                fd, tmpfile = tempfile.mkstemp(suffix='.nii', dir=os.getcwd())
+                with gzip.open(realigned_file, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+                imgseries = nb.load(tmpfile, mmap=True)
+            components = None
+            for filename in filename_to_list(mask_file):
+                mask = nb.load(filename).get_data()
+                if len(np.nonzero(mask > 0)[0]) == 0:
+                    continue
+                if svd_method == 'gram':
+                    # X X^T summed over slabs of voxels (the voxels are normalized
+                    # independently, so their order doesn't matter)
+                    gram = np.zeros((imgseries.shape[3], imgseries.shape[3]))
+                    for z in range(0, mask.shape[2], slab_size):
+                        slab_mask = mask[:, :, z:z + slab_size] > 0
+                        if not slab_mask.any():
+                            continue
+                        # X.shape == [time, nvoxels in slab]
+                        X = np.asarray(imgseries.dataobj[:, :, z:z + slab_size, :], dtype=float)[slab_mask].T
+                        X[:, np.isnan(np.sum(X, axis=0))] = 0
+                        stdX = np.std(X, axis=0)
+                        stdX[stdX == 0] = 1.
+                        stdX[np.isnan(stdX)] = 1.
+                        stdX[np.isinf(stdX)] = 1.
+                        X -= np.mean(X, axis=0)
+                        X /= stdX
+                        gram += np.dot(X, X.T)
+                    # left singular vectors of X, ordered by decreasing singular value
+                    _, eigvecs = eigh(gram)
+                    u = eigvecs[:, ::-1]
+                else:
+                    voxel_timecourses = imgseries.get_data()[mask > 0]
+                    voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
+                    # voxel_timecourses.shape == [nvoxels, time]
+                    X = voxel_timecourses.T
+                    # remove mean and normalize by variance
+                    stdX = np.std(X, axis=0)
+                    stdX[stdX == 0] = 1.
+                    stdX[np.isnan(stdX)] = 1.
+                    stdX[np.isinf(stdX)] = 1.
+                    X = (X - np.mean(X, axis=0)) / stdX
+                    u, _, _ = svd(X, full_matrices=False)
+                if components is None:
+                    components = u[:, :num_components]
+                else:
+                    components = np.hstack((components, u[:, :num_components]))
+        finally:
+            # remove the uncompressed copy (as large as the series) also on errors
+            if tmpfile is not None:
+                del imgseries
+                os.remove(tmpfile)
         if extra_regressors:
             regressors = np.genfromtxt(extra_regressors)
             components = np.hstack((components, regressors))
@@ -1242,13 +1344,15 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     createfilter2 = MapNode(Function(input_names=['realigned_file',
                                                   'mask_file',
                                                   'num_components',
-                                                  'extra_regressors'],
+                                                  'extra_regressors',
+                                                  'svd_method'],
                                      output_names=['out_files'],
                                      function=extract_noise_components,
                                      imports=imports),
                             iterfield=['realigned_file', 'extra_regressors'],
                             name='makecompcorrfilter')
     createfilter2.inputs.num_components = num_components
+    createfilter2.inputs.svd_method = compcor_svd
 
     wf.connect(createfilter1, 'out_files', createfilter2, 'extra_regressors')
     wf.connect(filter1, 'out_res', createfilter2, 'realigned_file')
@@ -1417,6 +1521,12 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     modelfit.inputs.inputspec.film_threshold = 1000
 
     datasink.inputs.base_directory = output_dir
+
+    """
+    Declare the cores and memory of the heavy nodes, for MultiProc
+    """
+
+    annotate_resources(wf, load_node_resources(resources_file))
     return wf
 
 
@@ -1433,7 +1543,8 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--datasetdir', required=True)
     parser.add_argument('-s', '--subject', default=[],
                         nargs='+', type=str,
-                        help="Subject name (e.g. 'sub001')")
+                        help="Subject names or ranges (e.g. 'sub001' or "
+                             "'sub001-sub004'), analyzed in one interleaved graph")
     parser.add_argument('-m', '--model', default=1,
                         help="Model index" + defstr)
     parser.add_argument('-x', '--subjectprefix', default='sub*',
@@ -1459,6 +1570,10 @@ if __name__ == '__main__':
                         help="Plugin to use")
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--n-procs", dest="n_procs", type=int,
+                        help="Cores shared by all nodes of all subjects (MultiProc)")
+    parser.add_argument("--memory-gb", dest="memory_gb", type=float,
+                        help="Memory shared by all nodes of all subjects (MultiProc)")
     parser.add_argument("--sd", dest="subjects_dir",
                         help="FreeSurfer subjects directory (if available)")
     parser.add_argument("--target", dest="target_file",
@@ -1467,6 +1582,22 @@ if __name__ == '__main__':
                               "OASIS-30_Atropos_template_in_MNI152_2mm.nii.gz"))
     parser.add_argument("--write-graph", default="",
                         help="Do not run, just write the graph to specified file")
+    parser.add_argument("--compcor-svd", dest="compcor_svd", default='full',
+                        choices=['full', 'gram'],
+                        help="Decomposition used for the CompCor noise components: "
+                             "'full' svd or top components from the time x time "
+                             "gram matrix" + defstr)
+    parser.add_argument("--reg-store", dest="reg_store",
+                        help="Directory of registration results shared by the "
+                             "pipeline variants; BBR and ANTs only run for new "
+                             "inputs or parameters")
+    parser.add_argument("--profile", dest="profile_dir",
+                        help="Monitor the cpu time, memory and I/O of every node and "
+                             "write node_profile.csv, node_summary.csv and "
+                             "critical_path.csv to this directory")
+    parser.add_argument("--node-resources", dest="resources_file",
+                        help="json file with n_procs and mem_gb per node name "
+                             "(default node_resources.json)")
     args = parser.parse_args()
     outdir = args.outdir
     work_dir = os.getcwd()
@@ -1482,7 +1613,8 @@ if __name__ == '__main__':
     if derivatives is None:
         derivatives = False
     wf = analyze_openfmri_dataset(data_dir=os.path.abspath(args.datasetdir),
-                                  subject=args.subject,
+                                  subject=[sub for spec in args.subject
+                                           for sub in expand_subjects(spec)],
                                   model_id=int(args.model),
                                   task_id=[int(args.task)],
                                   subj_prefix=args.subjectprefix,
@@ -1492,14 +1624,32 @@ if __name__ == '__main__':
                                   fwhm=args.fwhm,
                                   subjects_dir=args.subjects_dir,
                                   target=args.target_file,
+                                  compcor_svd=args.compcor_svd,
+                                  reg_store=os.path.abspath(args.reg_store) if args.reg_store else None,
+                                  resources_file=args.resources_file,
                                   refrun=args.mcrefrun)
 
     wf.config['execution']['remove_unnecessary_outputs'] = False
 
     wf.base_dir = work_dir
+    plugin_args = eval(args.plugin_args) if args.plugin_args else {}
+    # resource budget for a batch of subjects in one job, MultiProc packs the
+    # nodes of all subjects by their n_procs and mem_gb (node_resources.json)
+    if args.n_procs:
+        plugin_args['n_procs'] = args.n_procs
+    if args.memory_gb:
+        plugin_args['memory_gb'] = args.memory_gb
     if args.write_graph:
         wf.write_graph(args.write_graph, format='svg')
-    elif args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
+    elif args.profile_dir:
+        enable_resource_monitor(wf)
+        profiler = NodeProfiler()
+        plugin_args['status_callback'] = profiler
+        # also report on runs with failed nodes (without critical paths)
+        execgraph = None
+        try:
+            execgraph = wf.run(args.plugin, plugin_args=plugin_args)
+        finally:
+            profiler.write_reports(os.path.abspath(args.profile_dir), execgraph)
     else:
-        wf.run(args.plugin)
+        wf.run(args.plugin, plugin_args=plugin_args)
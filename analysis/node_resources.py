@@ -0,0 +1,58 @@
+"""
+Resource annotations of the heavy nodes of the first-level pipelines, so
+that MultiProc (n_procs, memory_gb) can pack them without oversubscribing.
+
+node_resources.json maps node names to the number of cores (n_procs) and
+memory (mem_gb) a node (or each MapNode iteration) needs. The same number of
+threads is passed to the tools themselves: via num_threads where the
+interface has it (ANTs), else via the OMP_NUM_THREADS and
+ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS environment of command line nodes.
+Numpy in Function nodes (e.g. makecompcorrfilter) uses the threads of the
+worker's environment.
+"""
+
+import json
+import os
+
+
+default_resources_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'node_resources.json')
+
+thread_variables = ['OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def load_node_resources(resources_file=None):
+    """
+    dict node name -> {'n_procs': .., 'mem_gb': ..} from resources_file
+    (default: node_resources.json next to this module)
+    """
+    with open(resources_file or default_resources_file) as f:
+        return json.load(f)
+
+
+def annotate_resources(workflow, resources):
+    """
+    Set n_procs, mem_gb and the number of threads of all nodes of workflow
+    (including nested workflows) whose name is in resources.
+    Returns the names of the annotated nodes.
+    """
+
+    annotated = []
+    for fullname in workflow.list_node_names():
+        node = workflow.get_node(fullname)
+        if node.name not in resources:
+            continue
+        n_procs = int(resources[node.name].get('n_procs', 1))
+        node.n_procs = n_procs
+        if 'mem_gb' in resources[node.name]:
+            # nipype has no setter for mem_gb
+            node._mem_gb = float(resources[node.name]['mem_gb'])
+
+        traits = node.inputs.trait_names()
+        if 'num_threads' in traits:
+            node.inputs.num_threads = n_procs
+        elif 'environ' in traits:
+            environ = dict(node.inputs.environ)
+            environ.update((variable, str(n_procs)) for variable in thread_variables)
+            node.inputs.environ = environ
+        annotated.append(fullname)
+    return annotated
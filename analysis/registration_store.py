@@ -0,0 +1,198 @@
+"""
+Registration result store shared by the first-level pipelines
+(fmri_ants_openfmri.py, _m2.py and _mc.py).
+
+The pipeline variants run the same BBR FLIRT (mean image to anat) and ANTs
+registration (anat to MNI) for every subject, each in its own nipype working
+directory, although the results only depend on the input images and the
+registration parameters. With a store directory, the antsRegister and
+mean2anatbbr nodes are replaced by Function nodes that look their results up
+under a hash of the input images and parameters, and only register on a miss.
+The results are linked into the node directories under their usual names
+(output_Composite.h5, output_InverseComposite.h5, median_flirt.mat, ...), so
+downstream nodes and the extraction scripts see no difference.
+"""
+
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import Function
+
+
+# inputs of the original nodes that don't change the result
+untracked_inputs = ('num_threads', 'environ', 'terminal_output', 'ignore_exception', 'output_type')
+
+
+def ants_registration(moving_image, fixed_image, settings, store_dir, num_threads=1):
+    """
+    ants.Registration of moving_image to fixed_image with settings (dict of
+    interface inputs), cached in store_dir.
+    Returns the composite transform, its inverse and the warped image.
+    """
+    import gzip
+    import hashlib
+    import os
+    import shutil
+    import tempfile
+    from nipype.interfaces import ants
+
+    def image_sha1(path):
+        # hash the uncompressed content, the gzip header holds a time stamp
+        sha = hashlib.sha1()
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+            for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    key = hashlib.sha1()
+    for path in (moving_image, fixed_image):
+        key.update(image_sha1(path).encode('utf-8'))
+    key.update(repr(sorted(settings.items())).encode('utf-8'))
+    entry = os.path.join(store_dir, 'ants_%s' % key.hexdigest()[:16])
+
+    prefix = settings.get('output_transform_prefix', 'transform')
+    names = [prefix + 'Composite.h5', prefix + 'InverseComposite.h5', settings['output_warped_image']]
+
+    if not os.path.isdir(entry):
+        try:
+            os.makedirs(store_dir)
+        except OSError:
+            if not os.path.isdir(store_dir):
+                raise
+        # register in a temporary directory and move it into place, so that
+        # pipelines running concurrently never see a partial entry
+        tmpdir = tempfile.mkdtemp(prefix='tmp_ants_', dir=store_dir)
+        cwd = os.getcwd()
+        try:
+            os.chdir(tmpdir)
+            ants.Registration(moving_image=moving_image, fixed_image=fixed_image,
+                              num_threads=num_threads, **settings).run()
+        except Exception:
+            shutil.rmtree(tmpdir)
+            raise
+        finally:
+            os.chdir(cwd)
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            # another pipeline stored the same registration in the meantime
+            shutil.rmtree(tmpdir)
+            if not os.path.isdir(entry):
+                raise
+
+    outputs = []
+    for name in names:
+        out_file = os.path.join(os.getcwd(), name)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        try:
+            os.link(os.path.join(entry, name), out_file)
+        except OSError:
+            shutil.copy(os.path.join(entry, name), out_file)
+        outputs.append(out_file)
+    return tuple(outputs)
+
+
+def flirt_registration(in_file, reference, wm_seg, in_matrix_file, settings, store_dir):
+    """
+    fsl.FLIRT of in_file to reference with settings (dict of interface
+    inputs, e.g. bbr cost and schedule), cached in store_dir.
+    Returns the registered image and the matrix, named like FLIRT's defaults
+    (<in_file>_flirt.nii.gz, <in_file>_flirt.mat).
+    """
+    import gzip
+    import hashlib
+    import os
+    import shutil
+    import tempfile
+    from nipype.interfaces import fsl
+    from nipype.utils.filemanip import split_filename
+
+    def image_sha1(path):
+        # hash the uncompressed content, the gzip header holds a time stamp
+        sha = hashlib.sha1()
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+            for block in iter(lambda: f.read(16 * 1024 * 1024), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    key = hashlib.sha1()
+    for path in (in_file, reference, wm_seg, in_matrix_file):
+        key.update(image_sha1(path).encode('utf-8'))
+    key.update(repr(sorted(settings.items())).encode('utf-8'))
+    entry = os.path.join(store_dir, 'flirt_%s' % key.hexdigest()[:16])
+
+    stem = split_filename(in_file)[1]
+    names = [stem + '_flirt.nii.gz', stem + '_flirt.mat']
+
+    if not os.path.isdir(entry):
+        try:
+            os.makedirs(store_dir)
+        except OSError:
+            if not os.path.isdir(store_dir):
+                raise
+        tmpdir = tempfile.mkdtemp(prefix='tmp_flirt_', dir=store_dir)
+        try:
+            fsl.FLIRT(in_file=in_file, reference=reference, wm_seg=wm_seg, in_matrix_file=in_matrix_file,
+                      out_file=os.path.join(tmpdir, names[0]), out_matrix_file=os.path.join(tmpdir, names[1]),
+                      **settings).run()
+        except Exception:
+            shutil.rmtree(tmpdir)
+            raise
+        try:
+            os.rename(tmpdir, entry)
+        except OSError:
+            shutil.rmtree(tmpdir)
+            if not os.path.isdir(entry):
+                raise
+
+    outputs = []
+    for name in names:
+        out_file = os.path.join(os.getcwd(), name)
+        if os.path.exists(out_file):
+            os.remove(out_file)
+        try:
+            os.link(os.path.join(entry, name), out_file)
+        except OSError:
+            shutil.copy(os.path.join(entry, name), out_file)
+        outputs.append(out_file)
+    return tuple(outputs)
+
+
+def node_settings(node):
+    """
+    inputs set on a (not yet connected) node, without untracked_inputs
+    """
+    return dict((name, value) for name, value in node.inputs.get().items()
+                if name not in untracked_inputs)
+
+
+def cached_ants_node(reg, store_dir):
+    """
+    Function node replacing the configured ants.Registration node reg (same
+    name, moving_image/fixed_image inputs and composite_transform,
+    inverse_composite_transform and warped_image outputs).
+    """
+    node = pe.Node(Function(input_names=['moving_image', 'fixed_image', 'settings', 'store_dir', 'num_threads'],
+                            output_names=['composite_transform', 'inverse_composite_transform', 'warped_image'],
+                            function=ants_registration),
+                   name=reg.name)
+    node.inputs.settings = node_settings(reg)
+    node.inputs.store_dir = store_dir
+    node.inputs.num_threads = reg.inputs.num_threads
+    node.plugin_args = reg.plugin_args
+    return node
+
+
+def cached_flirt_node(flirt, store_dir):
+    """
+    Function node replacing the configured (bbr) fsl.FLIRT node flirt (same
+    name, in_file/reference/wm_seg/in_matrix_file inputs and out_file,
+    out_matrix_file outputs).
+    """
+    node = pe.Node(Function(input_names=['in_file', 'reference', 'wm_seg', 'in_matrix_file', 'settings',
+                                         'store_dir'],
+                            output_names=['out_file', 'out_matrix_file'],
+                            function=flirt_registration),
+                   name=flirt.name)
+    node.inputs.settings = node_settings(flirt)
+    node.inputs.store_dir = store_dir
+    return node
@@ -0,0 +1,123 @@
+"""
+Roi extraction shared by the extraction scripts (extract_pe.py,
+extract_eigenvariate.py, tetrad/meants_tetrad.py) and the simulation.
+
+load_roi_block reads only the voxels within the bounding box of the rois
+(from a memory mapped uncompressed copy of gzipped runs, if a cache
+directory is given), and roi_means computes the mean of every roi for every
+sample in one sparse matrix product, instead of selecting the voxels of each
+roi for each sample.
+"""
+
+import nibabel as nb
+import numpy as np
+from scipy import sparse
+import gzip
+import hashlib
+import os
+import shutil
+from os.path import join
+
+
+def roi_label_matrix(roi):
+    """
+    Build a sparse (voxels x rois) indicator matrix from a flat roi mask
+    (integer roi values, 0 = background) that maps voxel values to roi means.
+    """
+
+    roi = np.asarray(roi)
+    nrois = int(max(roi))
+
+    # only voxels with an integer roi value between 1 and nrois belong to a roi
+    roi_int = roi.astype(int)
+    voxels = np.flatnonzero((roi_int == roi) & (roi_int >= 1))
+    labels = roi_int[voxels] - 1
+
+    # weight each voxel with 1 / size of its roi, so that a matrix product
+    # gives the mean instead of the sum.
+    counts = np.bincount(labels, minlength=nrois).astype(float)
+    return sparse.csc_matrix((1. / counts[labels], (voxels, labels)),
+                             shape=(len(roi), nrois))
+
+
+def roi_means(samples, roi):
+    """
+    Compute the mean of every roi for every sample (time point) in one pass.
+    samples is a (samples x voxels) array, roi the flat roi mask.
+    Returns a dense (samples x rois) float array.
+    """
+
+    indicator = roi_label_matrix(roi)
+    means = np.asarray(indicator.T.dot(np.asarray(samples).T).T, dtype=float)
+
+    # empty rois have no mean (np.mean of an empty selection gives nan as well)
+    means[:, np.diff(indicator.indptr) == 0] = np.nan
+    return means
+
+
+def cached_uncompressed(infile, cache_dir):
+    """
+    Return the path to an uncompressed copy of a gzipped nifti file in
+    cache_dir, which (unlike the .nii.gz) can be memory mapped. The copy is
+    created on first use and renewed if the original file is newer.
+    """
+    if not infile.endswith('.gz'):
+        return infile
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # runs of different subjects share the same file name, so prefix with a
+    # hash of the full path
+    pathhash = hashlib.sha1(os.path.abspath(infile).encode('utf-8')).hexdigest()[:12]
+    cached = join(cache_dir, '{}_{}'.format(pathhash, os.path.basename(infile)[:-3]))
+
+    if not os.path.exists(cached) or os.path.getmtime(cached) < os.path.getmtime(infile):
+        # decompress to a temporary file first, so that an interrupted job
+        # doesn't leave a truncated copy behind
+        tmpfile = cached + '.tmp%d' % os.getpid()
+        with gzip.open(infile, 'rb') as src, open(tmpfile, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 * 1024)
+        os.rename(tmpfile, cached)
+
+    return cached
+
+
+def roi_bounding_box(roi_data):
+    """
+    Bounding box of all roi voxels (value > 0) of a 3D roi mask array.
+    Returns the box (tuple of slices), the roi values within it and the
+    boolean mask of the roi voxels within it.
+    """
+
+    bbox = tuple(slice(idx.min(), idx.max() + 1) for idx in np.nonzero(roi_data > 0))
+    roi = roi_data[bbox]
+    return bbox, roi, roi > 0
+
+
+def load_roi_block(infile, mnimask, cache_dir=None, dtype=None):
+    """
+    Lazily load a 3D or 4D nifti file, reading only the voxels within the
+    bounding box of the rois in mnimask (which must be on the same grid).
+    With cache_dir, gzipped files are read from a memory mapped uncompressed
+    copy (see cached_uncompressed), otherwise the gzip stream is read piecewise.
+    Returns a (samples x voxels) array (of dtype, default: that of the file)
+    of the in-roi voxels and the corresponding flat roi values, to be used
+    with roi_means.
+    """
+
+    roi_data = np.asarray(nb.load(mnimask).dataobj)
+
+    if cache_dir is not None:
+        infile = cached_uncompressed(infile, cache_dir)
+    img = nb.load(infile, mmap=True)
+    assert img.shape[:3] == roi_data.shape
+
+    bbox, roi, inroi = roi_bounding_box(roi_data)
+
+    # only this slab is read from disk
+    block = np.asarray(img.dataobj[bbox], dtype=dtype)
+    if block.ndim == 3:
+        block = block[..., np.newaxis]
+
+    return block[inroi].T, roi[inroi]
@@ -6,8 +6,13 @@ source /etc/fsl/fsl.sh
 PATH=$PATH:/opt/convert3d
 export PATH
 
+# one subject or a range (e.g. sub001-sub004), analyzed in one graph
 sub=$1
 
+# resources of the job shared by all subjects
+nprocs=${NPROCS:-16}
+memgb=${MEMGB:-60}
+
 echo "Running script"
 PATH=$PATH:/usr/lib/ants/:/apps/convert3d/ python /home/scripts/glm/fmri_ants_openfmri.py \
   --hpfilter 60.0 --derivatives \
@@ -15,6 +20,6 @@ PATH=$PATH:/usr/lib/ants/:/apps/convert3d/ python /home/scripts/glm/fmri_ants_op
   -w /home/nobackup_l1ants_fwhm6_hp60_derivs_frac0.1_workdir \
   -o /home/results/l1ants_fwhm6_hp60_derivs_frac0.1 \
   -p MultiProc \
-  --plugin_args "{'n_procs': 16}" \
+  --n-procs $nprocs --memory-gb $memgb \
   -s $sub
   #--write-graph /data/famface/openfmri/oli/graph
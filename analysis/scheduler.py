@@ -0,0 +1,108 @@
+"""
+Run the extraction scripts for many subjects on one multi-core machine,
+instead of submitting one Condor/PBS job per subject.
+
+Each script splits its work into work items (e.g. one per subject and run,
+or per subject and stats type), which are distributed over a local process
+pool. Items whose output files already exist are skipped and failed items
+are retried.
+"""
+
+from collections import namedtuple
+import os
+import re
+import traceback
+
+
+# name: label for log messages, func: module level function (picklable),
+# kwargs: keyword arguments for func, outputs: list of files written by func
+WorkItem = namedtuple('WorkItem', ['name', 'func', 'kwargs', 'outputs'])
+
+
+def expand_subjects(subjects):
+    """
+    Expand a subject specification from the command line into a list.
+    Accepts single ids ('sub001'), comma separated lists ('sub001,sub004')
+    and ranges ('sub001-sub033', '1-33'), or combinations thereof.
+    """
+
+    expanded = []
+    for part in subjects.split(','):
+        match = re.match(r'^([^\d]*)(\d+)-\1(\d+)$', part)
+        if match:
+            prefix, first, last = match.groups()
+            expanded.extend(['%s%0*d' % (prefix, len(first), i)
+                             for i in range(int(first), int(last) + 1)])
+        elif part:
+            expanded.append(part)
+    return expanded
+
+
+def add_scheduler_arguments(parser):
+    """
+    Add the options of run_work_items to an argparse parser.
+    """
+
+    parser.add_argument('-j', '--n-workers', dest='n_workers', type=int, default=1,
+                        help='Number of worker processes (default %(default)s)')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='How often failed items are retried (default %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Also process items whose outputs already exist')
+    return parser
+
+
+def outputs_exist(item):
+    """
+    True if the item declares outputs and all of them exist.
+    """
+
+    return bool(item.outputs) and all(os.path.exists(out) for out in item.outputs)
+
+
+def run_work_items(items, n_workers=1, retries=1, skip_existing=True):
+    """
+    Process a list of WorkItems, either serially (n_workers=1) or with a pool
+    of n_workers processes.
+    Returns the names of the items that still failed after all retries.
+    """
+    todo = [item for item in items if not (skip_existing and outputs_exist(item))]
+    print('%d of %d work items to process (%d workers)' % (len(todo), len(items), n_workers))
+
+    for attempt in range(retries + 1):
+        if not todo:
+            break
+        if attempt:
+            print('retrying %d failed work items (attempt %d)' % (len(todo), attempt + 1))
+
+        failed = []
+        if n_workers == 1:
+            for item in todo:
+                try:
+                    item.func(**item.kwargs)
+                    print('finished %s' % item.name)
+                except Exception:
+                    traceback.print_exc()
+                    print('failed %s' % item.name)
+                    failed.append(item)
+        else:
+            # only here, so that the serial runs (e.g. the per subject batch
+            # jobs) and the python 2 first-level pipelines, which import
+            # expand_subjects, don't need the futures backport
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            pool = ProcessPoolExecutor(max_workers=n_workers)
+            futures = dict((pool.submit(item.func, **item.kwargs), item) for item in todo)
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    future.result()
+                    print('finished %s' % item.name)
+                except Exception as exc:
+                    print('failed %s: %r' % (item.name, exc))
+                    failed.append(item)
+            pool.shutdown()
+        todo = failed
+
+    for item in todo:
+        print('giving up on %s' % item.name)
+    return [item.name for item in todo]
@@ -9,10 +9,22 @@ subs=( $(seq -w 033) )
 # only for a subset
 #subs=( $(seq -w 009 018) )
 
-# loop over subs, submitting one job each
-for sub in "${subs[@]}"; do
-qsub -v sub="sub$sub" -N "$sub_sim_l1" pbssubmit_runl1.pbs
+# number of subjects per job. they share the 16 cores of the node, so one
+# subject's FILM runs while another one is in BET/FAST or registration
+batch=4
+
+# loop over batches of subs, submitting one job each
+for ((i = 0; i < ${#subs[@]}; i += batch)); do
+first=${subs[$i]}
+last=${subs[@]:$i:$batch}
+last=${last##* }
+qsub -v sub="sub$first-sub$last" -N "l1_sub$first" -l walltime=24:00:00 pbssubmit_runl1.pbs
 done
 
+# or one job per subject
+#for sub in "${subs[@]}"; do
+#qsub -v sub="sub$sub" -N "l1_sub$sub" pbssubmit_runl1.pbs
+#done
+
 # submit just one subj
 #qsub -v sub=sub001  pbssubmit_runl1.pbs
@@ -0,0 +1,149 @@
+"""
+Nearest neighbour projection of label images (roi masks) from mni space to
+the space of a subject's stats maps or bold runs via a voxel lookup table.
+
+mask2pe_ants (extract_pe.py) and mask2subjspace_real (simulation) invert the
+bbr affine, apply the ANTs composite transform to anat space and FLIRT the
+result to the reference grid, with external processes and intermediate files
+for every mask. Since both steps are nearest neighbour resampling, their
+composition just picks one source voxel per target voxel. So the chain is run
+once on an image holding the index of every voxel, which gives a lookup table
+(per subject and reference grid, cached on disk). Projecting any label image
+on the same mni grid then is a single numpy gather.
+"""
+
+from nipype.interfaces import fsl, ants
+from nipype.interfaces.fsl.utils import ConvertXFM
+import nibabel as nb
+import numpy as np
+import hashlib
+import os
+import shutil
+import tempfile
+from os.path import join
+
+
+def file_sha1(path, blocksize=16 * 1024 * 1024):
+    """
+    sha1 hex digest of the content of a file.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def grid_key(img):
+    """
+    string identifying the voxel grid (shape and affine) of a nibabel image
+    """
+    return '%r %r' % (tuple(img.shape[:3]), np.round(img.affine, 6).tolist())
+
+
+def project_index_image(template, anat, reference, mni2anat_hd5, affine_matrix, workdir):
+    """
+    Run the transformation chain of mask2pe_ants (inverse bbr affine, ANTs
+    composite transform, FLIRT, all nearest neighbour) on an image that holds
+    index + 1 of every voxel of template's grid.
+    Returns the lookup table: for every voxel of reference's grid the flat
+    index of its source voxel in template's grid, or -1 outside of it.
+    """
+
+    template_img = nb.load(template)
+    nvoxels = int(np.prod(template_img.shape[:3]))
+    # float32 represents all indices of a (2mm) mni grid exactly
+    assert nvoxels < 2 ** 24
+    index = np.arange(1, nvoxels + 1, dtype=np.float32).reshape(template_img.shape[:3])
+    index_file = join(workdir, 'index.nii.gz')
+    index_img = nb.Nifti1Image(index, template_img.affine)
+    index_img.set_data_dtype(np.float32)
+    index_img.to_filename(index_file)
+
+    # invert affine transmatrix (output from glm analysis)
+    affine_matrix_inverse = join(workdir, 'anat2pe.txt')
+    ConvertXFM(in_file=affine_matrix, out_file=affine_matrix_inverse, invert_xfm=True).run()
+
+    # apply inverse transform from mni to anat space
+    index2anat = join(workdir, 'index2anat.nii.gz')
+    ants.ApplyTransforms(
+        input_image=index_file, reference_image=anat, output_image=index2anat,
+        transforms=[mni2anat_hd5], dimension=3, interpolation='NearestNeighbor',
+        terminal_output='file').run()
+
+    # apply inverse affine transform from anat to the reference grid
+    index2ref = join(workdir, 'index2ref.nii.gz')
+    fsl.FLIRT(
+        interp='nearestneighbour', apply_xfm=True,
+        in_matrix_file=affine_matrix_inverse,
+        out_matrix_file=join(workdir, 'anat2ref_flirt.mat'),
+        in_file=index2anat, reference=reference, out_file=index2ref).run()
+
+    return np.rint(np.asarray(nb.load(index2ref).dataobj)).astype(np.int32) - 1
+
+
+def cached_lut(template, anat, reference, mni2anat_hd5, affine_matrix, cache_dir):
+    """
+    Lookup table of project_index_image, stored in cache_dir under a hash of
+    the transforms, the anatomical image and both grids (but not of the
+    template's content, so all masks on the same mni grid share it).
+    Returns the path of the .npz file with 'lut' and the reference 'affine'.
+    """
+
+    key = hashlib.sha1()
+    for path in (anat, mni2anat_hd5, affine_matrix):
+        key.update(file_sha1(path).encode('utf-8'))
+    for path in (template, reference):
+        key.update(grid_key(nb.load(path)).encode('utf-8'))
+    lutfile = join(cache_dir, 'lut_%s.npz' % key.hexdigest()[:16])
+    if os.path.exists(lutfile):
+        return lutfile
+
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+
+    # compute in a temporary directory and move the table into place, so
+    # that concurrent jobs don't interfere
+    tmpdir = tempfile.mkdtemp(prefix='tmp_lut_', dir=cache_dir)
+    try:
+        lut = project_index_image(template, anat, reference, mni2anat_hd5, affine_matrix, tmpdir)
+        with open(join(tmpdir, 'lut.npz'), 'wb') as f:
+            np.savez_compressed(f, lut=lut, affine=nb.load(reference).affine)
+        os.rename(join(tmpdir, 'lut.npz'), lutfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return lutfile
+
+
+def project_labels(labels, lutfile, reference, outfile):
+    """
+    Project the label image labels (on the grid of the lookup table's
+    template) to the grid of reference and save it to outfile.
+    """
+
+    with np.load(lutfile) as npz:
+        lut = npz['lut']
+    label_data = np.asarray(nb.load(labels).dataobj)
+
+    projected = label_data.ravel()[np.maximum(lut, 0)]
+    projected[lut < 0] = 0
+
+    ref = nb.load(reference)
+    assert ref.shape[:3] == lut.shape
+    img = nb.Nifti1Image(projected, ref.affine)
+    img.set_data_dtype(label_data.dtype)
+    img.to_filename(outfile)
+    return outfile
+
+
+def lut_mask2pe(mnimask, anat, pe, mni2anat_hd5, affine_matrix, workdir, lut_cache_dir):
+    """
+    Drop-in replacement of mask2pe_ants: project mnimask to the grid of pe,
+    writing workdir/mask2pe.nii.gz, with the (cached) lookup table.
+    """
+    lutfile = cached_lut(mnimask, anat, pe, mni2anat_hd5, affine_matrix, lut_cache_dir)
+    return project_labels(mnimask, lutfile, pe, join(workdir, 'mask2pe.nii.gz'))
@@ -0,0 +1,216 @@
+"""
+Resource profile of a nipype workflow run (fmri_ants_openfmri*.py --profile).
+
+NodeProfiler is passed to the plugin as status callback. For every finished
+node and MapNode iteration it records the wall time and, from nipype's
+resource monitor, the cpu time, peak RSS and peak cpu usage. The I/O is
+estimated from files: the size of the node's existing input files (read) and
+of its working directory after the run (written).
+
+write_reports then writes to the profile directory
+    node_profile.csv  one row per node (and MapNode iteration)
+    node_summary.csv  the same aggregated per node over subjects, to size
+                      n_procs, mem_gb and batch job requests
+    critical_path.csv the chain of dependent nodes with the longest total
+                      wall time, per subject
+"""
+
+import csv
+import os
+import re
+import time
+from collections import OrderedDict
+
+import networkx as nx
+
+
+profile_fields = ['subject', 'node', 'iteration', 'status', 'start', 'wall_s', 'cpu_s', 'peak_rss_gb',
+                  'max_cpu_percent', 'read_bytes', 'written_bytes']
+
+
+def enable_resource_monitor(workflow, sample_frequency=1):
+    """
+    Switch on nipype's resource monitor (sampling every sample_frequency
+    seconds), globally and in the config of workflow, which is passed on to
+    the nodes (and so to worker processes); call before the workflow runs.
+    """
+    from nipype import config
+    config.enable_resource_monitor()
+    config.set('monitoring', 'sample_frequency', str(sample_frequency))
+    workflow.config['monitoring'] = {'enabled': 'true', 'sample_frequency': str(sample_frequency)}
+
+
+def subject_of(node_dir):
+    """
+    subject id from the iterable in a node's working directory, or 'all'
+    """
+    match = re.search(r'_subject_id_([^/]+)', node_dir)
+    return match.group(1) if match else 'all'
+
+
+def file_bytes(value):
+    """
+    total size of the existing files in an input value (file name or nested
+    lists of file names)
+    """
+    if isinstance(value, (list, tuple)):
+        return sum(file_bytes(v) for v in value)
+    if isinstance(value, (str, type(u''))) and os.path.isfile(value):
+        return os.path.getsize(value)
+    return 0
+
+
+def dir_bytes(path):
+    """
+    total size of the files below path
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if not os.path.islink(filename):
+                total += os.path.getsize(filename)
+    return total
+
+
+def runtime_stats(runtime):
+    """
+    cpu time (integrated from the monitor's samples), peak RSS and peak cpu
+    percent of an interface runtime; None where the monitor was off
+    """
+    prof = getattr(runtime, 'prof_dict', None) or {}
+    times, cpus = prof.get('time', []), prof.get('cpus', [])
+    cpu_s = None
+    if len(times) > 1:
+        cpu_s = sum((times[i + 1] - times[i]) * cpus[i] / 100. for i in range(len(times) - 1))
+    return cpu_s, getattr(runtime, 'mem_peak_gb', None), getattr(runtime, 'cpu_percent', None)
+
+
+class NodeProfiler(object):
+    """
+    Status callback for the nipype plugins (plugin_args['status_callback']).
+    """
+
+    def __init__(self):
+        self.started = {}
+        # node directory -> row (dict with profile_fields)
+        self.rows = OrderedDict()
+
+    def __call__(self, node, status):
+        node_dir = node.output_dir()
+        if status == 'start':
+            self.started[node_dir] = time.time()
+            return
+
+        start = self.started.pop(node_dir, None)
+        finish = time.time()
+        match = re.match(r'^_(.+?)(\d+)$', node.name)
+        if match and '%smapflow%s' % (os.sep, os.sep) in node_dir:
+            # iteration of a MapNode, run as a node of its own
+            name = '%s.%s' % (node.fullname.rsplit('.', 1)[0], match.group(1))
+            iteration = int(match.group(2))
+        else:
+            name, iteration = node.fullname, ''
+
+        row = dict(subject=subject_of(node_dir), node=name, iteration=iteration,
+                   status='ok' if status == 'end' else 'failed',
+                   start=start, wall_s=finish - start if start else None,
+                   read_bytes=file_bytes(list(node.inputs.get().values())),
+                   written_bytes=dir_bytes(node_dir))
+        try:
+            runtime = node.result.runtime
+        except Exception:
+            runtime = None
+        if isinstance(runtime, list):
+            # MapNode run in one piece (e.g. Linear plugin), one row per iteration
+            # (unless the plugin ran the iterations as nodes of their own)
+            for i, iter_runtime in enumerate(runtime):
+                iter_dir = os.path.join(node_dir, 'mapflow', '_%s%d' % (node.name, i))
+                if iter_dir in self.rows:
+                    continue
+                iter_row = dict(row, iteration=i, start=None, wall_s=getattr(iter_runtime, 'duration', None),
+                                read_bytes=None, written_bytes=dir_bytes(iter_dir))
+                iter_row['cpu_s'], iter_row['peak_rss_gb'], iter_row['max_cpu_percent'] = runtime_stats(iter_runtime)
+                self.rows[iter_dir] = iter_row
+        else:
+            row['cpu_s'], row['peak_rss_gb'], row['max_cpu_percent'] = runtime_stats(runtime)
+            self.rows[node_dir] = row
+
+    def node_span(self, node_dir):
+        """
+        wall time from the first start to the last end of the rows of a node
+        and its MapNode iterations, in seconds
+        """
+        rows = [row for path, row in self.rows.items()
+                if (path == node_dir or path.startswith(node_dir + os.sep)) and row['wall_s']]
+        spans = [(row['start'], row['start'] + row['wall_s']) for row in rows if row['start']]
+        if not spans:
+            # iterations of a MapNode run in one piece only have durations
+            return sum(row['wall_s'] for row in rows)
+        return max(end for start, end in spans) - min(start for start, end in spans)
+
+    def critical_paths(self, execgraph):
+        """
+        Longest chain of dependent nodes (by wall time) for each subject.
+        Returns a dict subject -> list of (node name, wall time).
+        """
+        durations = dict((node, self.node_span(node.output_dir())) for node in execgraph.nodes())
+        longest, previous = {}, {}
+        for node in nx.topological_sort(execgraph):
+            subject = subject_of(node.output_dir())
+            preds = [p for p in execgraph.predecessors(node) if subject_of(p.output_dir()) in (subject, 'all')]
+            best = max(preds, key=lambda p: longest[p]) if preds else None
+            longest[node] = durations[node] + (longest[best] if best is not None else 0.)
+            previous[node] = best
+
+        paths = {}
+        for subject in set(subject_of(node.output_dir()) for node in execgraph.nodes()):
+            candidates = [node for node in longest if subject_of(node.output_dir()) == subject]
+            node = max(candidates, key=lambda n: longest[n])
+            path = []
+            while node is not None:
+                path.append((node.fullname, durations[node]))
+                node = previous[node]
+            paths[subject] = path[::-1]
+        return paths
+
+    def write_reports(self, profile_dir, execgraph=None):
+        """
+        Write node_profile.csv, node_summary.csv and (given the execution
+        graph returned by Workflow.run) critical_path.csv to profile_dir.
+        """
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+        with open(os.path.join(profile_dir, 'node_profile.csv'), 'w') as f:
+            writer = csv.DictWriter(f, profile_fields)
+            writer.writeheader()
+            for row in self.rows.values():
+                writer.writerow(dict((k, '' if row.get(k) is None else row[k]) for k in profile_fields))
+
+        summary = OrderedDict()
+        for row in self.rows.values():
+            summary.setdefault(row['node'], []).append(row)
+        with open(os.path.join(profile_dir, 'node_summary.csv'), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['node', 'runs', 'total_wall_s', 'max_wall_s', 'total_cpu_s', 'mean_cpus',
+                             'max_peak_rss_gb', 'total_written_bytes'])
+            for name, rows in summary.items():
+                wall = [r['wall_s'] for r in rows if r['wall_s'] is not None]
+                cpu = [r['cpu_s'] for r in rows if r['cpu_s'] is not None]
+                rss = [r['peak_rss_gb'] for r in rows if r['peak_rss_gb'] is not None]
+                writer.writerow([name, len(rows), sum(wall), max(wall) if wall else '',
+                                 sum(cpu) if cpu else '',
+                                 # average number of busy cores while the node ran
+                                 '%.2f' % (sum(cpu) / sum(wall)) if cpu and sum(wall) else '',
+                                 max(rss) if rss else '', sum(r['written_bytes'] or 0 for r in rows)])
+
+        if execgraph is not None:
+            with open(os.path.join(profile_dir, 'critical_path.csv'), 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['subject', 'step', 'node', 'wall_s', 'cumulative_s'])
+                for subject, path in sorted(self.critical_paths(execgraph).items()):
+                    cumulative = 0.
+                    for step, (name, wall) in enumerate(path):
+                        cumulative += wall
+                        writer.writerow([subject, step, name, wall, cumulative])
@@ -0,0 +1,30 @@
+#!/usr/bin/python
+
+"""
+Simulate all functional images of a BIDS data set (noise only) into
+<bids_dir>/derivatives/sub-XX/shambrain/.
+"""
+
+if __name__ == "__main__":
+
+    import argparse
+    import sys
+    from famface_simulation_functions import run4bids
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('bids_dir')
+    parser.add_argument('-j', '--n-workers', dest='n_workers', type=int, default=1,
+                        help='Number of files simulated in parallel (default %(default)s)')
+    parser.add_argument('--workdir', default=None,
+                        help='base of the working directories (default: <bids_dir>/derivatives/shamwork)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed offset for reproducible noise')
+    parser.add_argument('--compresslevel', type=int, default=1, choices=range(10),
+                        help='gzip level of the outputs, 0 = uncompressed (default %(default)s)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='also simulate files whose output already exists')
+    args = parser.parse_args()
+
+    failed = run4bids(args.bids_dir, n_workers=args.n_workers, workdir=args.workdir, seed=args.seed,
+                      compresslevel=args.compresslevel, overwrite=args.overwrite)
+    sys.exit(1 if failed else 0)
@@ -5,19 +5,181 @@ Simulate fMRI run with no activation.
 """
 
 import numpy as np
-from mvpa2.datasets.mri import fmri_dataset
+import nibabel as nb
+from mvpa2.datasets.base import Dataset
+from mvpa2.datasets.mri import fmri_dataset, map2nifti
 from mvpa2.misc.data_generators import autocorrelated_noise
 from mvpa2.misc.data_generators import simple_hrf_dataset
 from nipype.interfaces import fsl
+import copy
 import csv
+import gzip
 import os
+import shutil
+import sys
+import time
+import zlib
 from os.path import join
-import itertools
+from collections import OrderedDict
+from glob import glob
 from nipype.interfaces.fsl.utils import ConvertXFM
 from nipype.interfaces import fsl, ants
 
+# the analysis helpers (transform_lut, roi_extract) and the tetrad extraction (meants_tetrad)
+for module_dir in ('analysis', 'tetrad'):
+    module_dir = join(os.path.dirname(os.path.abspath(__file__)), '..', module_dir)
+    if module_dir not in sys.path:
+        sys.path.insert(0, module_dir)
+from roi_extract import roi_means
+from transform_lut import file_sha1, lut_mask2pe
 
-def simulate_run(infile, workdir, lfnl=3, hfnl=.5):
+
+def butterworth_gain(nsamples, sr, cutoff, bord=10):
+    """
+    Magnitude response of the digital low-pass butterworth filter of order
+    bord (scipy.signal.butter(bord, cutoff / (sr / 2))) at the frequencies
+    of the real fft of a time series with nsamples samples.
+    """
+    # normalized angular frequencies (rad / sample)
+    w = 2 * np.pi * np.fft.rfftfreq(nsamples)
+    wc = np.pi * cutoff / (sr / 2.)
+    # the filter is designed via the bilinear transform, hence the tan.
+    # (at the nyquist frequency, the gain is 0)
+    with np.errstate(over='ignore'):
+        return 1. / np.sqrt(1 + (np.tan(w / 2) / np.tan(wc / 2)) ** (2 * bord))
+
+
+def native_autocorrelated_noise(samples, sr, cutoff, lfnl=3.0, hfnl=None, bord=10,
+                                seed=None, dtype=np.float32, mask=None, chunksize=10000):
+    """
+    Generate temporally autocorrelated noise like PyMVPA's
+    autocorrelated_noise, but for all voxels at once: gaussian noise is
+    scaled to lfnl percent of each voxel's mean signal, low-pass filtered in
+    the frequency domain (with the magnitude response of the same butterworth
+    filter, see butterworth_gain), optionally mixed with hfnl percent white
+    noise, and added to the voxel's mean signal.
+
+    Parameters
+    ----------
+    samples:    array
+        (time points x voxels) data, whose temporal mean is the pedestal of the noise.
+    sr:         float
+        Sampling rate in Hz
+    cutoff:     float
+        Cutoff frequency of the low-pass filter in Hz
+    seed:       int
+        Seed of the random number generator (None: not reproducible)
+    dtype:      numpy dtype
+        Type of the returned array
+    mask:       array
+        Boolean array (voxels). If given, noise is only generated for the
+        voxels in the mask, the others keep their mean signal.
+    chunksize:  int
+        Number of voxels processed at once (to limit memory usage)
+
+    Returns
+    -------
+    (time points x voxels) array of simulated data
+    """
+
+    samples = np.asarray(samples)
+    return noise_from_mean(samples.mean(axis=0), len(samples), sr, cutoff, lfnl=lfnl, hfnl=hfnl, bord=bord,
+                           seed=seed, dtype=dtype, mask=mask, chunksize=chunksize)
+
+
+def noise_from_mean(msample, nsamples, sr, cutoff, lfnl=3.0, hfnl=None, bord=10,
+                    seed=None, dtype=np.float32, mask=None, chunksize=10000):
+    """
+    native_autocorrelated_noise given only the mean signal of each voxel
+    (msample) and the number of time points to simulate.
+    """
+
+    msample = np.asarray(msample, dtype=float)
+    nvoxels = len(msample)
+    rng = np.random.RandomState(seed)
+    gain = butterworth_gain(nsamples, sr, cutoff, bord)
+
+    # every voxel starts out with its mean signal (pedestal)
+    simulated = np.empty((nsamples, nvoxels), dtype=dtype)
+    simulated[:] = msample.astype(dtype)
+
+    voxels = np.arange(nvoxels) if mask is None else np.flatnonzero(mask)
+    for start in range(0, len(voxels), chunksize):
+        chunk = voxels[start:start + chunksize]
+        pedestal = msample[chunk][:, np.newaxis]
+
+        # gaussian noise (voxels x time points), scaled relative to each
+        # voxel's mean signal before filtering, as in PyMVPA (so the filter's
+        # gain lowers the amplitude of the low-frequency noise)
+        noise = rng.standard_normal((len(chunk), nsamples))
+        noise *= pedestal * (lfnl / 100.)
+        fnoise = np.fft.irfft(np.fft.rfft(noise, axis=1) * gain, n=nsamples, axis=1)
+
+        # add HF noise if desired
+        if hfnl is not None:
+            fnoise += rng.standard_normal((len(chunk), nsamples)) * pedestal * (hfnl / 100.)
+
+        # finally add pedestal to noise
+        fnoise += pedestal
+        simulated[:, chunk] = fnoise.T
+
+    return simulated
+
+
+def motion_corrected_template(infile, cache_dir):
+    """
+    Motion correct a functional image with MCFLIRT and compute its temporal
+    mean and standard deviation and the TR. The results are kept in
+    cache_dir, under a name derived from the hash of infile's content, so
+    that repeated simulations of the same run skip MCFLIRT entirely.
+
+    Returns
+    -------
+    mcfile:     str
+        Path to the motion corrected 4D image
+    meanfile:   str
+        Path to its mean image (with the header of mcfile)
+    stats:      dict
+        'mean' and 'std' (3D arrays), 'tr' (in seconds) and 'nsamples'
+    """
+
+    key = file_sha1(infile)[:16]
+    mcfile = join(cache_dir, '%s_mc.nii.gz' % key)
+    meanfile = join(cache_dir, '%s_mcmean.nii.gz' % key)
+    statsfile = join(cache_dir, '%s_mcstats.npz' % key)
+
+    if not all(os.path.exists(f) for f in (mcfile, meanfile, statsfile)):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # perform motion correction using mcflirt implemented by nipype.
+        # (into a temporary file, which is only renamed when complete)
+        fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+        tmpfile = join(cache_dir, '%s_mc_tmp%d.nii.gz' % (key, os.getpid()))
+        mcflt = fsl.MCFLIRT(in_file=infile,
+                            out_file=tmpfile)
+        mcflt.run()
+
+        # derived statistics
+        img = nb.load(tmpfile)
+        data = np.asarray(img.dataobj, dtype=np.float32)
+        mean, std = data.mean(axis=3), data.std(axis=3)
+        tr = float(img.header.get_zooms()[3])
+        if img.header.get_xyzt_units()[1] == 'msec':
+            tr /= 1000.
+
+        nb.Nifti1Image(mean, img.affine, img.header).to_filename(meanfile)
+        np.savez(statsfile[:-len('.npz')] + '_tmp.npz', mean=mean, std=std, tr=tr, nsamples=data.shape[3])
+        os.rename(statsfile[:-len('.npz')] + '_tmp.npz', statsfile)
+        os.rename(tmpfile, mcfile)
+
+    with np.load(statsfile) as npz:
+        stats = dict(mean=npz['mean'], std=npz['std'], tr=float(npz['tr']), nsamples=int(npz['nsamples']))
+    return mcfile, meanfile, stats
+
+
+def simulate_run(infile, workdir, lfnl=3, hfnl=.5, engine='native', seed=None, dtype=np.float32, mask=None,
+                 mc_cache_dir=None):
     """
     Simple simulation of 4D fmri data. Takes a given functional image,
     performs motion correction, computes the mean and adds autocorrelated
@@ -33,79 +195,204 @@ def simulate_run(infile, workdir, lfnl=3, hfnl=.5):
         Low frequency noise level. Default = 3 Hz
     hfnl:       float
         High frequency noise level. Default = None.
+    engine:     str
+        'native' (native_autocorrelated_noise, default) or 'pymvpa'
+        (PyMVPA's autocorrelated_noise, which ignores seed, dtype and mask)
+    seed:       int
+        Seed for the noise of the native engine
+    dtype:      numpy dtype
+        Type of the simulated samples (native engine)
+    mask:       str
+        Path to a brain mask (in the space of infile). Noise is only
+        generated within the mask (native engine)
+    mc_cache_dir:   str
+        Directory for the motion corrected image and its statistics
+        (see motion_corrected_template). Default: workdir
     """
 
-    # perform motion correction using mcflirt implemented by nipype.
-    fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
-    infilename = infile.split('/')[-1]
-    mcfile = os.path.join(workdir, infilename.replace('.nii.gz', '_mc.nii.gz'))
-    mcflt = fsl.MCFLIRT(in_file=infile,
-                        out_file=mcfile)
-    mcflt.run()
+    # motion correction (or cached results thereof)
+    if mc_cache_dir is None:
+        mc_cache_dir = workdir
+    mcfile, meanfile, stats = motion_corrected_template(infile, mc_cache_dir)
 
-    # load the preprocessed nifti as pymvpa data set
-    ds = fmri_dataset(mcfile)
-
-    # get TR from sample attributes
-    tr = float(ds.sa['time_coords'][1] - ds.sa['time_coords'][0])
-
-    # convert to sampling rate in Hz
+    # convert TR to sampling rate in Hz
+    tr = stats['tr']
     sr = 1.0 / tr
     cutoff = sr / 4
 
     # produce simulated 4D fmri data
-    shambold = autocorrelated_noise(ds, sr, cutoff, lfnl=lfnl, hfnl=hfnl)
+    if engine == 'pymvpa':
+        # load the preprocessed nifti as pymvpa data set
+        ds = fmri_dataset(mcfile)
+        return autocorrelated_noise(ds, sr, cutoff, lfnl=lfnl, hfnl=hfnl)
+
+    # the native engine only needs the mean image
+    meands = fmri_dataset(meanfile)
+    if mask is not None:
+        mask = fmri_dataset(mask).samples[0] > 0
+    nsamples = stats['nsamples']
+    samples = noise_from_mean(meands.samples[0], nsamples, sr, cutoff, lfnl=lfnl, hfnl=hfnl,
+                              seed=seed, dtype=dtype, mask=mask)
+    shambold = Dataset(samples,
+                       sa=dict(time_indices=np.arange(nsamples), time_coords=np.arange(nsamples) * tr),
+                       fa=meands.fa, a=meands.a)
     return shambold
 
 
-def get_onsets_famface(inpath, amplitudes):
+# parsed onsets of each onset directory (see famface_onsets)
+onset_cache = {}
+
+
+def famface_onsets(inpath):
     """
-    get event onsets from text file
+    Sorted onsets of familiar (cond006-009) and unfamiliar (cond002-005)
+    faces from the onset directory of a run, as two tuples.
+    Each directory is only read once per process.
     """
 
+    inpath = os.path.abspath(inpath)
+    if inpath in onset_cache:
+        return onset_cache[inpath]
+
     if not os.path.exists(inpath):
         raise ValueError('the specified input path does not exist')
     else:
         confiles = os.listdir(inpath)
 
-    famfiles = ['cond006.txt', 'cond007.txt', 'cond008.txt', 'cond009.txt']
-    fam_paths = [os.path.join(inpath, confile) for confile in confiles if confile in famfiles]
+    def read_onsets(condfiles):
+        # collect onsets of all given conditions
+        onsets = []
+        for confile in confiles:
+            if confile in condfiles:
+                with open(os.path.join(inpath, confile)) as f:
+                    reader = csv.reader(f, delimiter='\t')
+                    onsets.extend(float(row[0]) for row in reader if row)
+        return tuple(sorted(onsets))
 
+    famfiles = ['cond006.txt', 'cond007.txt', 'cond008.txt', 'cond009.txt']
     unfamfiles = ['cond002.txt', 'cond003.txt', 'cond004.txt', 'cond005.txt']
-    unfam_paths = [os.path.join(inpath, confile) for confile in confiles if confile in unfamfiles]
-
-    # collect onsets of all familiar faces
-    fam_onsets = []
-    for fam in fam_paths:
-        with open(fam) as f:
-            reader = csv.reader(f, delimiter='\t')
-            fam_onsets.append(list(zip(*reader))[0])
-    fam_onsets = list(itertools.chain(*fam_onsets))
-    fam_onsets = sorted([float(i) for i in fam_onsets])
-
-    # and for unfamiliar faces
-    unfam_onsets = []
-    for unfam in unfam_paths:
-        with open(unfam) as f:
-            reader = csv.reader(f, delimiter='\t')
-            unfam_onsets.append(list(zip(*reader))[0])
-    unfam_onsets = list(itertools.chain(*unfam_onsets))
-    unfam_onsets = sorted([float(i) for i in unfam_onsets])
-
-    spec = [{'chunks': 0, 'duration': 1.5, 'onset': fam_onsets, 'targets': 'familiar', 'amplitude': amplitudes[0], 'roivalue': 2},
-            {'chunks': 0, 'duration': 1.5, 'onset': unfam_onsets, 'targets': 'unfamiliar', 'amplitude': amplitudes[1],
+    onset_cache[inpath] = (read_onsets(famfiles), read_onsets(unfamfiles))
+    return onset_cache[inpath]
+
+
+def get_onsets_famface(inpath, amplitudes):
+    """
+    get event onsets from text file
+    """
+
+    fam_onsets, unfam_onsets = famface_onsets(inpath)
+
+    spec = [{'chunks': 0, 'duration': 1.5, 'onset': list(fam_onsets), 'targets': 'familiar', 'amplitude': amplitudes[0], 'roivalue': 2},
+            {'chunks': 0, 'duration': 1.5, 'onset': list(unfam_onsets), 'targets': 'unfamiliar', 'amplitude': amplitudes[1],
              'roivalue': 2}]
 
     return spec
 
 
-def add_signal_custom(ds, ms, spec, tpeak=0.8, fwhm=1, fir_length=15):
+# convolved hrf regressors, least recently used first (see hrf_regressor)
+hrf_cache = OrderedDict()
+hrf_cache_size = 256
+
+
+def hrf_regressor(onsets, tr, nsamples, tres, baseline=0, signal_level=1):
+    """
+    hrf model of the given events (first feature of PyMVPA's
+    simple_hrf_dataset without noise). The last hrf_cache_size regressors are
+    kept in memory, so each is only computed once. The returned array is
+    read-only, since it is shared between callers.
+    """
+
+    key = (tuple(float(onset) for onset in onsets), float(tr), int(nsamples), float(tres),
+           float(baseline), float(signal_level))
+    if key in hrf_cache:
+        regressor = hrf_cache.pop(key)
+    else:
+        regressor = simple_hrf_dataset(events=list(onsets), nsamples=nsamples, tr=tr, tres=tres,
+                                       baseline=baseline, signal_level=signal_level,
+                                       noise_level=0).samples[:, 0]
+        regressor.flags.writeable = False
+
+    # (re-)insert as most recently used
+    hrf_cache[key] = regressor
+    while len(hrf_cache) > hrf_cache_size:
+        hrf_cache.popitem(last=False)
+    return regressor
+
+
+def famface_spec(onsetpath, amplitudes, roivalues=(2, 24), straight_amplitudes=(8, 1)):
+    """
+    Specification of the simulated signal for one run: familiar and
+    unfamiliar faces with the given amplitudes in roi roivalues[0], and
+    (as a contrast that does not change over runs) with straight_amplitudes
+    in roi roivalues[1].
+    """
+
+    spec = get_onsets_famface(onsetpath, amplitudes)
+    for cond in spec:
+        cond['roivalue'] = roivalues[0]
+
+    # create second specification for contrast that does not increase
+    # in different roi
+    straightspec = copy.deepcopy(spec)
+    for cond, amplitude in zip(straightspec, straight_amplitudes):
+        cond['amplitude'] = amplitude
+        cond['roivalue'] = roivalues[1]
+    return spec + straightspec
+
+
+def real_transforms(sub, betas_dir='/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/'):
+    """
+    Paths to the brain extracted anatomical image, the ANTs mni to anat
+    transform and the bbr affine of a subject from the analysis of the real
+    data (for mask2subjspace_real).
+    """
+
+    # template for directory name containing subjects data in the working directory
+    subdir_template = '_model_id_1_subject_id_%s_task_id_1' % sub
+
+    anat = join(betas_dir, 'registration', subdir_template, 'stripper', 'highres001_brain.nii.gz')
+    mni2anat_hd5 = join(betas_dir, 'registration', subdir_template, 'antsRegister', 'output_InverseComposite.h5')
+    affine_matrix = join(betas_dir, 'registration', subdir_template, 'mean2anatbbr', 'median_flirt.mat')
+    return anat, mni2anat_hd5, affine_matrix
+
+
+def run_seed(sub, run, offset=0):
+    """
+    Seed for the noise of a run, different for all subjects and runs.
+    """
+    return (zlib.crc32(('%s_%s' % (sub, run)).encode('utf-8')) + offset) % 2 ** 31
+
+
+def condition_regressors(spec, nsamples, tr):
+    """
+    Model the hrf of all conditions in spec.
+    Returns a (nsamples x conditions) array of multiplicative activations
+    (baseline 1, peak 1 + amplitude / 100).
+    """
+
+    regressors = np.empty((nsamples, len(spec)))
+    for i, cond in enumerate(spec):
+        sigchange = float(cond['amplitude']) / 100
+        # model twice the run length, so that the hrf of late events isn't cut off
+        regressors[:, i] = hrf_regressor(cond['onset'], tr, nsamples * 2, tres=1,
+                                         baseline=1, signal_level=sigchange)[:nsamples]
+    return regressors
+
+
+def add_signal_custom(ds, ms, spec, tpeak=0.8, fwhm=1, fir_length=15, dtype=np.float32):
     """
     add signal to a pure noise simulated image
     (as generated e.g. by simulate_run)
+
+    The roi voxels of every sample are multiplied with the modelled activation
+    of each condition in spec for that roi. All conditions are applied at once:
+    the activations of conditions sharing a roi are multiplied into one
+    (samples x rois) matrix, which scales the roi voxels in a single
+    broadcasted multiplication on a copy of the samples (of type dtype).
     """
 
-    dataset_with_signal = ds.copy()
+    dataset_with_signal = ds.copy(deep=False)
+    dataset_with_signal.samples = np.array(ds.samples, dtype=dtype)
     ms = fmri_dataset(ms)
 
     """
@@ -116,42 +403,253 @@ def add_signal_custom(ds, ms, spec, tpeak=0.8, fwhm=1, fir_length=15):
     nsamples = len(ds.samples)
 
     """
-    loop over specified conditions
+    add activation to data set
     """
-    for cond in spec:
-        # condition = spec['conditions'][cond]
-        roivalue = cond['roivalue']
-        onsets = cond['onset']
-        amplitude = cond['amplitude']
-        sigchange = float(amplitude) / 100
-
-        # get voxel indices for roi
-        roi_indices = np.where(ms.samples[0] == roivalue)[0]
-
-        """
-        model hrf
-        """
-        hrf_model = simple_hrf_dataset(events=onsets, nsamples=nsamples * 2, tr=tr, tres=1, baseline=1,
-                                       signal_level=sigchange,
-                                       noise_level=0).samples[:, 0]
-        """
-        add activation to data set
-        """
-        # add model activation to roi voxels
-        # import pdb; pdb.set_trace()
-        for sample, activation in zip(dataset_with_signal.samples, hrf_model):
-            sample[roi_indices] *= activation
+    in_roi, activation = roi_activation(ms.samples[0], spec, nsamples, tr)
+    dataset_with_signal.samples[:, in_roi] *= activation.astype(dtype)
 
     return dataset_with_signal
 
 
-def mask2subjspace_real(mnimask, anat, pe, mni2anat_hd5, affine_matrix, workdir):
+def roi_activation(roi, spec, nsamples, tr):
+    """
+    Model the hrf of all conditions in spec and combine the conditions of
+    each roi (by multiplication).
+    Returns the indices of the voxels in roi (flat roi mask) that receive
+    signal, and their (nsamples x voxels) multiplicative activation.
+    """
+
+    regressors = condition_regressors(spec, nsamples, tr)
+
+    # combine the conditions of each roi
+    roivalues = sorted(set(cond['roivalue'] for cond in spec))
+    activation = np.ones((nsamples, len(roivalues)))
+    for i, cond in enumerate(spec):
+        activation[:, roivalues.index(cond['roivalue'])] *= regressors[:, i]
+
+    # roi voxels and the column of their roi in activation
+    roi = np.asarray(roi)
+    in_roi = np.flatnonzero(np.isin(roi, roivalues))
+    roi_columns = np.searchsorted(roivalues, roi[in_roi])
+
+    return in_roi, activation[:, roi_columns]
+
+
+def realizations(infile, mask_subjspace, spec, seeds, roi_only=True, lfnl=3, hfnl=.5,
+                 mc_cache_dir=None, dtype=np.float32):
+    """
+    Generate one realization of noise plus signal (as simulate_run and
+    add_signal_custom) per seed for the same run.
+
+    The static parts (motion correction and mean image, roi mask, hrf model)
+    are computed once, only noise and injected signal are regenerated for
+    each realization. If roi_only, only the voxels in the rois of
+    mask_subjspace are simulated (so the same seed gives different noise than
+    for the whole image).
+
+    Yields (seed, samples, roi) for every realization, with samples the
+    simulated (time points x voxels) data and roi the flat roi values of
+    these voxels.
+
+    mc_cache_dir is passed to motion_corrected_template (default: the
+    directory of mask_subjspace, i.e. the run's working directory).
+    """
+
+    if mc_cache_dir is None:
+        mc_cache_dir = os.path.dirname(os.path.abspath(mask_subjspace))
+    mcfile, meanfile, stats = motion_corrected_template(infile, mc_cache_dir)
+    nsamples, tr = stats['nsamples'], stats['tr']
+    sr = 1.0 / tr
+    cutoff = sr / 4
+
+    roi = np.asarray(nb.load(mask_subjspace).dataobj).ravel()
+    assert len(roi) == stats['mean'].size
+
+    # voxels to simulate
+    voxels = np.flatnonzero(roi > 0) if roi_only else np.arange(len(roi))
+    msample = stats['mean'].ravel()[voxels]
+
+    # activation of the voxels receiving signal (positions within voxels)
+    in_roi, activation = roi_activation(roi, spec, nsamples, tr)
+    signal_voxels = np.searchsorted(voxels, in_roi)
+    activation = activation.astype(dtype)
+
+    for seed in seeds:
+        sim = noise_from_mean(msample, nsamples, sr, cutoff, lfnl=lfnl, hfnl=hfnl, seed=seed, dtype=dtype)
+        sim[:, signal_voxels] *= activation
+        yield seed, sim, roi[voxels]
+
+
+def import_meants_tetrad():
+    """
+    import the extraction module of the tetrad analysis
+    (for its roi reduction and writers)
+    """
+    import meants_tetrad
+    return meants_tetrad
+
+
+def simulate_realizations(infile, mask_subjspace, spec, outfile, seeds, lfnl=3, hfnl=.5,
+                          sink='roi', mc_cache_dir=None, dtype=np.float32):
+    """
+    Monte-Carlo version of simulate_run and add_signal_custom: simulate one
+    realization of noise plus signal per seed for the same run (see
+    realizations). Instead of writing a NIfTI file per realization, the
+    results go to
+
+    sink='roi': the mean time series of each roi in mask_subjspace (rois are
+        numbered 1..n), saved to outfile (.npz) as 'timeseries'
+        (realizations x time points x rois), with 'seeds'. Noise is only
+        generated for the roi voxels (so the same seed gives different noise
+        than with sink='h5').
+    sink='h5':  the full simulated images, saved to outfile (HDF5, requires
+        h5py) as dataset 'sim' (realizations x time points x X x Y x Z),
+        chunked by volume, with 'seeds' and the 'affine' as attributes.
+
+    mc_cache_dir is passed to motion_corrected_template (default: the
+    directory of outfile).
+    """
+
+    if sink not in ('roi', 'h5'):
+        raise ValueError("sink must be 'roi' or 'h5'")
+    if mc_cache_dir is None:
+        mc_cache_dir = os.path.dirname(os.path.abspath(outfile))
+
+    maskimg = nb.load(mask_subjspace)
+    tmpfile = outfile + '.tmp%d' % os.getpid()
+    if sink == 'roi':
+        timeseries = []
+    else:
+        import h5py
+        h5 = h5py.File(tmpfile, 'w')
+        sim_dset = None
+        h5.attrs['seeds'] = seeds
+        h5.attrs['affine'] = maskimg.affine
+
+    for i, (seed, sim, roi) in enumerate(realizations(infile, mask_subjspace, spec, seeds,
+                                                      roi_only=sink == 'roi', lfnl=lfnl, hfnl=hfnl,
+                                                      mc_cache_dir=mc_cache_dir, dtype=dtype)):
+        if sink == 'roi':
+            timeseries.append(roi_means(sim, roi).astype(np.float32))
+        else:
+            if sim_dset is None:
+                sim_dset = h5.create_dataset('sim', shape=(len(seeds), len(sim)) + maskimg.shape[:3],
+                                             dtype=dtype, chunks=(1, 1) + maskimg.shape[:3])
+            sim_dset[i] = sim.reshape((len(sim),) + maskimg.shape[:3])
+        print('finished realization %d of %d' % (i + 1, len(seeds)))
+
+    if sink == 'roi':
+        with open(tmpfile, 'wb') as f:
+            np.savez(f, timeseries=np.array(timeseries), seeds=np.asarray(seeds))
+    else:
+        h5.close()
+    os.rename(tmpfile, outfile)
+    return outfile
+
+
+def simulate_run_roispace(infile, mask_subjspace, spec, out_dir, sub_id, run, seed=None,
+                          with_contrast_onsets=None, store=False,
+                          labelcsv='/data/famface/openfmri/github/notebooks/roi_coord.csv',
+                          lfnl=3, hfnl=.5, mc_cache_dir=None):
+    """
+    Simulate a run (like simulate_run and add_signal_custom) only for the
+    voxels in the rois of mask_subjspace, reduce it to roi mean time series
+    right away and write them like meants_tetrad does for real data
+    (out_dir/csv/<run>/<sub>_<run>.csv, or to the subject's HDF5 store if store).
+    with_contrast_onsets: onset directory of the run, to add the
+    familiar vs. unfamiliar regressor (see meants_tetrad.add_contrast).
+    mc_cache_dir is passed to motion_corrected_template (default: out_dir).
+    Returns the (time points x rois) time series.
+    """
+
+    meants_tetrad = import_meants_tetrad()
+    if mc_cache_dir is None:
+        mc_cache_dir = out_dir
+
+    seed, sim, roi = next(realizations(infile, mask_subjspace, spec, [seed], roi_only=True,
+                                       lfnl=lfnl, hfnl=hfnl, mc_cache_dir=mc_cache_dir))
+    timeseries = roi_means(sim, roi)
+
+    # same header as meants_tetrad
+    header = [pair[1].replace(' ', '') for pair in meants_tetrad.getlabels(labelcsv)]
+    if with_contrast_onsets is not None:
+        header.append('FAM-UNFAM')
+        timeseries = meants_tetrad.add_contrast(timeseries, with_contrast_onsets)
+
+    if store:
+        storefile = meants_tetrad.open_store(out_dir, sub_id)
+        try:
+            # add to a copy of the existing store of this subject, which
+            # replaces it once the run is written (so a failure leaves the
+            # store with the earlier runs in place)
+            if os.path.exists(meants_tetrad.store_path(out_dir, sub_id)):
+                shutil.copyfile(meants_tetrad.store_path(out_dir, sub_id), storefile)
+            meants_tetrad.write_run(timeseries, out_dir, sub_id, run, header, storefile)
+            meants_tetrad.close_store(storefile, out_dir, sub_id)
+        finally:
+            if os.path.exists(storefile):
+                os.remove(storefile)
+    else:
+        meants_tetrad.write_run(timeseries, out_dir, sub_id, run, header)
+
+    return timeseries
+
+
+def save_nifti(img, outfile, compresslevel=1):
+    """
+    Save a nibabel image atomically: write to a hidden temporary file next to
+    outfile and rename it when complete, so that a crashed job never leaves
+    a truncated image behind (that the GLM would pick up).
+
+    compresslevel sets the gzip level (1 = fastest, 9 = smallest). With 0,
+    the image is written uncompressed, and a '.gz' extension of outfile is
+    dropped. Returns the path of the written file.
+    """
+
+    if compresslevel == 0 and outfile.endswith('.gz'):
+        outfile = outfile[:-3]
+    outdir = os.path.dirname(os.path.abspath(outfile))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    # hidden, so that it doesn't match 'sim.nii*'
+    tmpfile = join(outdir, '.tmp%d_%s' % (os.getpid(), os.path.basename(outfile)))
+    try:
+        if outfile.endswith('.gz'):
+            with gzip.GzipFile(tmpfile, 'wb', compresslevel=compresslevel) as f:
+                file_map = img.make_file_map()
+                file_map['image'].fileobj = f
+                img.to_file_map(file_map)
+        else:
+            with open(tmpfile, 'wb') as f:
+                file_map = img.make_file_map()
+                file_map['image'].fileobj = f
+                img.to_file_map(file_map)
+        os.rename(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+    # remove a copy with the other compression from an earlier call
+    other = outfile[:-3] if outfile.endswith('.gz') else outfile + '.gz'
+    if os.path.exists(other):
+        os.remove(other)
+    return outfile
+
+
+def mask2subjspace_real(mnimask, anat, pe, mni2anat_hd5, affine_matrix, workdir, lut_cache_dir=None):
     """
     Simulate data based on transformation matrices already obtained
     from analysis of real data.
     (This is the same as mask2pe_ants in extract_pe.py for extracting parameter estimates).
+    If lut_cache_dir is given, the mask is projected with a voxel lookup table
+    cached there (see analysis/transform_lut.py), which all runs with the same
+    grid share.
     """
 
+    if lut_cache_dir is not None:
+        return lut_mask2pe(mnimask, anat, pe, mni2anat_hd5, affine_matrix, workdir, lut_cache_dir)
+
     """
     paths for temporary files and output file
     """
@@ -356,30 +854,30 @@ def get_filepaths_bids(bids_dir):
         List of path names for all files in the subjects' 'func' subdirectory
     outfiles:   list
         List of path names for the to be saved simulated functinoal images.
-        Will be saved under '/derivatives/sub-XX/sham/'.
+        Will be saved under '/derivatives/sub-XX/shambrain/'.
     """
 
-    infiles, outfiles = [], []
-
-    subdirs = [directory for directory in os.listdir(bids_dir)
-               if directory.startswith('sub-')]
+    infiles = sorted(glob(os.path.join(bids_dir, 'sub-*', 'func', '*.nii.gz')))
+    outfiles = [os.path.join(bids_dir, 'derivatives', infile.split(os.sep)[-3], 'shambrain',
+                             os.path.basename(infile).replace('.nii.gz', '_sham.nii.gz'))
+                for infile in infiles]
 
-    for sub in subdirs:
-
-        funcs = [dircontent for dircontent in
-                 os.listdir(os.path.join(bids_dir, sub, 'func'))
-                 if dircontent.endswith('.nii.gz')]
+    return infiles, outfiles
 
-        for func in funcs:
-            infiles.append(os.path.join(bids_dir, sub, 'func', func))
-            outfiles.append(os.path.join(
-                bids_dir, 'derivatives', sub, 'shambrain',
-                func.replace('.nii.gz', '_sham.nii.gz')))
 
-    return infiles, outfiles
+def simulate_bids_file(infile, outfile, workdir, seed=None, compresslevel=1):
+    """
+    Simulate one functional image of a BIDS data set (noise only, see
+    simulate_run) and save it to outfile.
+    """
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+    shambold = simulate_run(infile, workdir, seed=seed)
+    save_nifti(map2nifti(shambold), outfile, compresslevel=compresslevel)
+    return outfile
 
 
-def run4bids(bids_dir):
+def run4bids(bids_dir, n_workers=1, workdir=None, seed=None, compresslevel=1, overwrite=False):
     """
     runs simulation for all functional images in a BIDS data set.
 
@@ -388,9 +886,53 @@ def run4bids(bids_dir):
     bids_dir:   str
         Base directory of the BIDS data set. Should contain the subject
         folders ('sub-001' etc.)
+    n_workers:  int
+        Number of files simulated in parallel
+    workdir:    str
+        Base of the working directories (one per file).
+        Default: <bids_dir>/derivatives/shamwork
+    seed:       int
+        If given, the noise of each file is seeded with this offset
+        (and the file name), otherwise it is not reproducible
+    compresslevel:  int
+        gzip level of the outputs (see save_nifti)
+    overwrite:  bool
+        Also simulate files whose output already exists
+
+    Returns
+    -------
+    List of input files that failed.
     """
 
-    for inf, outf in zip(get_filepaths_bids(bids_dir)):
-        simulate_run(inf, outf)
+    if workdir is None:
+        workdir = os.path.join(bids_dir, 'derivatives', 'shamwork')
+
+    todo = [(inf, outf) for inf, outf in zip(*get_filepaths_bids(bids_dir))
+            if overwrite or not os.path.exists(outf)]
+    print('simulating %d files with %d workers' % (len(todo), n_workers))
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    pool = ProcessPoolExecutor(max_workers=n_workers)
+    futures = {}
+    for inf, outf in todo:
+        name = os.path.basename(inf).replace('.nii.gz', '')
+        file_seed = None if seed is None else run_seed(name, 'bids', seed)
+        futures[pool.submit(simulate_bids_file, inf, outf, os.path.join(workdir, name),
+                            seed=file_seed, compresslevel=compresslevel)] = inf
+
+    # report progress and throughput
+    failed = []
+    start = time.time()
+    for done, future in enumerate(as_completed(futures), 1):
+        try:
+            future.result()
+        except Exception as exc:
+            print('failed %s: %r' % (futures[future], exc))
+            failed.append(futures[future])
+        minutes = (time.time() - start) / 60.
+        print('%d/%d files done, %.1f files/min' % (done, len(todo), done / max(minutes, 1e-6)))
+    pool.shutdown()
+
+    return failed
 
 # TODO: function to create a condor submission file
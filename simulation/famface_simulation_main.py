@@ -7,31 +7,50 @@ Run simulation over our data
 if __name__ == "__main__":
 
     from os.path import join
-    import copy
     from famface_simulation_functions import *
     from mvpa2.datasets.mri import fmri_dataset, map2nifti
-    import sys
-
-    sub = sys.argv[1]
-    data_basedir = sys.argv[2]
-    maskpath = sys.argv[3]
-    workdirbase = sys.argv[4]
-
-    # template for directory name containing subjects data in the working directory
-    subdir_template = '_model_id_1_subject_id_%s_task_id_1' % sub
-
-    # path to anatomical image
-    anat = join('/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/',
-                'registration', subdir_template, 'stripper',
-                'highres001_brain.nii.gz')
-
-    # path to hd5 file and affine transformation matrix
-    mni2anat_hd5 = join('/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/',
-                        'registration', subdir_template,
-                        'antsRegister', 'output_InverseComposite.h5')
-    affine_matrix = join('/data/famface/openfmri/oli/results/extract_betas/l1_workdir_betas/',
-                         'registration', subdir_template,
-                         'mean2anatbbr', 'median_flirt.mat')
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulate our runs with noise and familiarity signal.')
+    parser.add_argument('sub')
+    parser.add_argument('data_basedir')
+    parser.add_argument('maskpath')
+    parser.add_argument('workdirbase')
+    # optional: directory for motion corrected images shared by repeated simulations
+    # (default: the run's working directory)
+    parser.add_argument('mc_cache_dir', nargs='?', default=None)
+    # monte-carlo batch mode: N realizations per run, written to
+    # <workdirbase>/<sub>/<run>/sim_realizations.npz (or .h5) instead of sim.nii.gz
+    parser.add_argument('--realizations', type=int, default=0,
+                        help='number of noise realizations per run (batch mode)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='offset for the seeds of the realizations')
+    parser.add_argument('--sink', choices=['roi', 'h5'], default='roi',
+                        help="'roi': roi mean time series (npz), 'h5': full images (HDF5)")
+    # roi-space mode: simulate only the roi voxels and write roi time series like
+    # meants_tetrad.py to <workdirbase>/<sub>/csv/<run>/<sub>_<run>.csv instead of sim.nii.gz
+    parser.add_argument('--roi-space', action='store_true',
+                        help='write roi mean time series instead of the simulated image')
+    parser.add_argument('--with-contrast', action='store_true',
+                        help='roi-space mode: add the familiar vs. unfamiliar regressor')
+    parser.add_argument('--store', action='store_true',
+                        help='roi-space mode: write to the HDF5 store of the subject instead of csv')
+    # where to write the simulated images (<out_root>/<sub>/BOLD/<run>/sim.nii[.gz]),
+    # by default next to the real data
+    parser.add_argument('--out-root', default=None,
+                        help='output root for simulated images (default: data_basedir)')
+    parser.add_argument('--compresslevel', type=int, default=1, choices=range(10),
+                        help='gzip level of the simulated images, 0 = uncompressed (default %(default)s)')
+    args = parser.parse_args()
+
+    sub = args.sub
+    data_basedir = args.data_basedir
+    maskpath = args.maskpath
+    workdirbase = args.workdirbase
+    mc_cache_dir = args.mc_cache_dir
+
+    # anatomical image, hd5 file and affine transformation matrix
+    anat, mni2anat_hd5, affine_matrix = real_transforms(sub)
 
     # maskpath = '/data/famface/openfmri/scripts/notebooks/rois_manual_r5_20170222_nooverlap.nii.gz'
 
@@ -52,33 +71,44 @@ if __name__ == "__main__":
         # path to bold file
         boldfile = join(data_basedir, sub, 'BOLD', run, 'bold.nii.gz')
 
-        # simulate noise image
-        noise = simulate_run(boldfile, workdir)
-
-        # get onsets
-        spec = get_onsets_famface(
+        # get onsets (amplitudes in roi 2, constant amplitudes in roi 24)
+        spec = famface_spec(
             os.path.join(data_basedir, sub, 'model/model001/onsets', run),
             amplitudes)
 
         # increment amplitude for unfam
         amplitudes[1] += 0.5
 
-        # create second specification for contrast that does not increase
-        # in different roi
-        straightspec = copy.deepcopy(spec)
-        straightspec[0]['amplitude'] = 8
-        straightspec[1]['amplitude'] = 1
-        for cond in straightspec:
-            cond['roivalue'] = 24
-            spec.append(cond)
-
         # transform mask to subject space
-        mask_subjspace = mask2subjspace_real(maskpath, anat, boldfile,mni2anat_hd5, affine_matrix, workdir)
+        # (via a lookup table shared by all runs of the subject)
+        mask_subjspace = mask2subjspace_real(maskpath, anat, boldfile,mni2anat_hd5, affine_matrix, workdir,
+                                             lut_cache_dir=os.path.join(workdirbase, sub, 'transform_lut'))
+
+        # seeds differ between subjects and runs
+        first_seed = run_seed(sub, run, args.seed)
+
+        if args.roi_space:
+            onsets = os.path.join(data_basedir, sub, 'model/model001/onsets', run)
+            simulate_run_roispace(boldfile, mask_subjspace, spec, os.path.join(workdirbase, sub), sub, run,
+                                  seed=first_seed, with_contrast_onsets=onsets if args.with_contrast else None,
+                                  store=args.store, mc_cache_dir=mc_cache_dir or workdir)
+            continue
+
+        if args.realizations:
+            seeds = [first_seed + i for i in range(args.realizations)]
+            simulate_realizations(
+                boldfile, mask_subjspace, spec,
+                os.path.join(workdir, 'sim_realizations.%s' % ('npz' if args.sink == 'roi' else 'h5')),
+                seeds, sink=args.sink, mc_cache_dir=mc_cache_dir)
+            continue
+
+        # simulate noise image
+        noise = simulate_run(boldfile, workdir, mc_cache_dir=mc_cache_dir)
 
         # add signal
         with_signal = add_signal_custom(noise, mask_subjspace, spec)
 
         # save data
         image = map2nifti(with_signal)
-        image.to_filename(
-            os.path.join(data_basedir, sub, 'BOLD', run, 'sim.nii.gz'))
+        save_nifti(image, os.path.join(args.out_root or data_basedir, sub, 'BOLD', run, 'sim.nii.gz'),
+                   compresslevel=args.compresslevel)
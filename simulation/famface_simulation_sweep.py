@@ -0,0 +1,164 @@
+#!/usr/bin/python
+"""
+Sweep the simulation over a grid of signal amplitudes, roi values, noise
+levels and seeds, in a local process pool.
+
+Each configuration is simulated in roi space (see simulate_run_roispace) for
+all runs of the given subjects, into <out_base_dir>/<config id>/<sub>/.
+The configurations and the status of their outputs are recorded in
+<out_base_dir>/sweep_index.csv.
+
+Mask projection and motion correction don't depend on the configuration,
+so they are done once per subject and run (in <out_base_dir>/prep/) before
+the sweep starts.
+"""
+
+import csv
+import itertools
+import os
+import sys
+from os.path import join, dirname, abspath
+
+from famface_simulation_functions import famface_spec, mask2subjspace_real, motion_corrected_template, \
+    real_transforms, run_seed, simulate_run_roispace
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', 'analysis'))
+from scheduler import WorkItem, add_scheduler_arguments, expand_subjects, run_work_items
+
+
+# parameters of a configuration, in the order of the columns of the index
+config_fields = ['fam_amplitude', 'unfam_amplitude', 'unfam_increment', 'roi_increasing', 'roi_constant',
+                 'lfnl', 'hfnl', 'seed']
+
+
+def get_runs(data_basedir, sub):
+    return sorted(os.listdir(join(data_basedir, sub, 'model/model001/onsets')))
+
+
+def prep_marker(prep_dir, sub, run):
+    """
+    file written by prepare_subject once a run is prepared completely
+    (the motion correction results are named after a hash of the run)
+    """
+    return join(prep_dir, sub, run, 'prep_done')
+
+
+def prepare_subject(sub, data_basedir, maskpath, prep_dir):
+    """
+    Project the mask into the space of each run and motion correct the runs
+    of one subject (the parts of the simulation shared by all configurations).
+    """
+    anat, mni2anat_hd5, affine_matrix = real_transforms(sub)
+    for run in get_runs(data_basedir, sub):
+        workdir = join(prep_dir, sub, run)
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        boldfile = join(data_basedir, sub, 'BOLD', run, 'bold.nii.gz')
+        mask2subjspace_real(maskpath, anat, boldfile, mni2anat_hd5, affine_matrix, workdir,
+                            lut_cache_dir=join(prep_dir, sub, 'transform_lut'))
+        motion_corrected_template(boldfile, workdir)
+        open(prep_marker(prep_dir, sub, run), 'w').close()
+
+
+def simulate_config(sub, data_basedir, prep_dir, out_dir, config):
+    """
+    Simulate all runs of one subject for one configuration (dict with
+    config_fields), in roi space. Like famface_simulation_main.py, the
+    unfamiliar amplitude is incremented with each run.
+    """
+    amplitudes = [config['fam_amplitude'], config['unfam_amplitude']]
+    for run in get_runs(data_basedir, sub):
+        spec = famface_spec(join(data_basedir, sub, 'model/model001/onsets', run), amplitudes,
+                            roivalues=(config['roi_increasing'], config['roi_constant']))
+        amplitudes[1] += config['unfam_increment']
+
+        workdir = join(prep_dir, sub, run)
+        simulate_run_roispace(join(data_basedir, sub, 'BOLD', run, 'bold.nii.gz'),
+                              join(workdir, 'mask2pe.nii.gz'), spec, out_dir, sub, run,
+                              seed=run_seed(sub, run, config['seed']),
+                              lfnl=config['lfnl'], hfnl=config['hfnl'], mc_cache_dir=workdir)
+
+
+def expand_grid(args):
+    """
+    All combinations of the parameters given on the command line, as a list
+    of (config id, config dict).
+    """
+    values = [args.fam_amplitudes, args.unfam_amplitudes, args.unfam_increments, args.roi_increasing,
+              args.roi_constant, args.lfnl, args.hfnl, args.seeds]
+    return [('cfg%04d' % i, dict(zip(config_fields, combination)))
+            for i, combination in enumerate(itertools.product(*values))]
+
+
+def write_index(index_file, grid, subs, out_base_dir, failed):
+    """
+    Write one row per configuration and subject with the parameters, the
+    output directory and whether the simulation succeeded.
+    """
+    with open(index_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['config', 'sub'] + config_fields + ['out_dir', 'status'])
+        for config_id, config in grid:
+            for sub in subs:
+                name = '%s %s' % (config_id, sub)
+                writer.writerow([config_id, sub] + [config[field] for field in config_fields] +
+                                [join(out_base_dir, config_id, sub), 'failed' if name in failed else 'ok'])
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Parameter sweep of the famface simulation.')
+    parser.add_argument('subjects', help="e.g. 'sub001' or 'sub001-sub033'")
+    parser.add_argument('data_basedir')
+    parser.add_argument('maskpath')
+    parser.add_argument('out_base_dir')
+    parser.add_argument('--fam-amplitudes', type=float, nargs='+', default=[8])
+    parser.add_argument('--unfam-amplitudes', type=float, nargs='+', default=[1],
+                        help='amplitude of unfamiliar faces in the first run')
+    parser.add_argument('--unfam-increments', type=float, nargs='+', default=[.5],
+                        help='increment of the unfamiliar amplitude per run')
+    parser.add_argument('--roi-increasing', type=int, nargs='+', default=[2],
+                        help='roi value receiving the incremented amplitudes')
+    parser.add_argument('--roi-constant', type=int, nargs='+', default=[24],
+                        help='roi value receiving the constant amplitudes (8, 1)')
+    parser.add_argument('--lfnl', type=float, nargs='+', default=[3])
+    parser.add_argument('--hfnl', type=float, nargs='+', default=[.5])
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+
+    subs = expand_subjects(args.subjects)
+    grid = expand_grid(args)
+    prep_dir = join(args.out_base_dir, 'prep')
+    print('%d configurations x %d subjects' % (len(grid), len(subs)))
+
+    # shared preparation, one item per subject
+    prep_failed = run_work_items(
+        [WorkItem(name=sub, func=prepare_subject,
+                  kwargs=dict(sub=sub, data_basedir=args.data_basedir, maskpath=args.maskpath,
+                              prep_dir=prep_dir),
+                  outputs=[output for run in get_runs(args.data_basedir, sub)
+                           for output in (join(prep_dir, sub, run, 'mask2pe.nii.gz'),
+                                          prep_marker(prep_dir, sub, run))])
+         for sub in subs],
+        n_workers=args.n_workers, retries=args.retries, skip_existing=not args.overwrite)
+    subs = [sub for sub in subs if sub not in prep_failed]
+
+    # the sweep, one item per configuration and subject
+    items = []
+    for config_id, config in grid:
+        for sub in subs:
+            out_dir = join(args.out_base_dir, config_id, sub)
+            items.append(WorkItem(
+                name='%s %s' % (config_id, sub), func=simulate_config,
+                kwargs=dict(sub=sub, data_basedir=args.data_basedir, prep_dir=prep_dir,
+                            out_dir=out_dir, config=config),
+                outputs=[join(out_dir, 'csv', run, '%s_%s.csv' % (sub, run))
+                         for run in get_runs(args.data_basedir, sub)]))
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+
+    write_index(join(args.out_base_dir, 'sweep_index.csv'), grid, subs, args.out_base_dir, failed)
+    sys.exit(1 if failed or prep_failed else 0)
@@ -706,7 +706,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                              task_id=None, output_dir=None, subj_prefix='*',
                              hpcutoff=120., use_derivatives=True,
                              fwhm=6.0, subjects_dir=None, target=None,
-                             num_components=5):
+                             num_components=5, sim_dir=None):
     """Analyzes an open fmri dataset
 
     Parameters
@@ -714,6 +714,10 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     data_dir : str
         Path to the base data directory
 
+    sim_dir : str
+        Output root of the simulation, if the simulated runs
+        (<sub>/BOLD/<run>/sim.nii or sim.nii.gz) are not in data_dir
+
     work_dir : str
         Nipype working directory (defaults to cwd)
     """
@@ -791,9 +795,14 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     datasource.inputs.template = '*'
 
     # TODO: Modify input path for BOLD
+    # simulated runs, compressed or not (but not the hidden temporary files
+    # of unfinished simulations)
+    bold_template = '%s/BOLD/task%03d_r*/sim.nii*'
+    if sim_dir:
+        bold_template = os.path.join(os.path.abspath(sim_dir), bold_template)
     if has_contrast:
         datasource.inputs.field_template = {'anat': '%s/anatomy/highres001.nii.gz',
-                                            'bold': '%s/BOLD/task%03d_r*/sim.nii.gz',
+                                            'bold': bold_template,
                                             'behav': ('%s/model/model%03d/onsets/task%03d_'
                                                       'run%03d/cond*.txt'),
                                             'contrasts': ('models/model%03d/'
@@ -805,7 +814,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                            'contrasts': [['model_id']]}
     else:
         datasource.inputs.field_template = {'anat': '%s/anatomy/highres001.nii.gz',
-                                            'bold': '%s/BOLD/task%03d_r*/sim.nii.gz',
+                                            'bold': bold_template,
                                             'behav': ('%s/model/model%03d/onsets/task%03d_'
                                                       'run%03d/cond*.txt')}
         datasource.inputs.template_args = {'anat': [['subject_id']],
@@ -1450,6 +1459,8 @@ if __name__ == '__main__':
                               "OASIS-30_Atropos_template_in_MNI152_2mm.nii.gz"))
     parser.add_argument("--write-graph", default="",
                         help="Do not run, just write the graph to specified file")
+    parser.add_argument("--simdir", dest="sim_dir",
+                        help="Output root of the simulation (default: datasetdir)")
     args = parser.parse_args()
     outdir = args.outdir
     work_dir = os.getcwd()
@@ -1474,7 +1485,8 @@ if __name__ == '__main__':
                                   use_derivatives=derivatives,
                                   fwhm=args.fwhm,
                                   subjects_dir=args.subjects_dir,
-                                  target=args.target_file)
+                                  target=args.target_file,
+                                  sim_dir=args.sim_dir)
     wf.config['execution']['remove_unnecessary_outputs'] = False
 
     wf.base_dir = work_dir
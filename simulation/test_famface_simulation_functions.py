@@ -0,0 +1,47 @@
+"""
+Tests of the native noise engine against PyMVPA's autocorrelated_noise
+(run with pytest from this directory).
+"""
+
+import os
+import sys
+
+import numpy as np
+from scipy.signal import butter, lfilter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from famface_simulation_functions import noise_from_mean
+
+
+def pymvpa_noise(msample, nsamples, sr, cutoff, lfnl, bord=10, seed=0):
+    """
+    low-frequency noise as generated by mvpa2.misc.data_generators.
+    autocorrelated_noise: white noise scaled to lfnl percent of the mean,
+    then filtered with the butterworth low-pass
+    """
+    rng = np.random.RandomState(seed)
+    noise = rng.standard_normal((nsamples, len(msample))) * (msample * lfnl / 100.)
+    b, a = butter(bord, cutoff / (sr / 2.))
+    return lfilter(b, a, noise, axis=0) + msample
+
+
+def lag1_autocorrelation(samples):
+    centered = samples - samples.mean(axis=0)
+    return np.mean(np.sum(centered[1:] * centered[:-1], axis=0) / np.sum(centered ** 2, axis=0))
+
+
+def test_native_noise_matches_pymvpa():
+    sr = .5
+    cutoff = sr / 4.
+    nsamples, nvoxels = 400, 2000
+    msample = np.random.RandomState(1).uniform(500, 1500, nvoxels)
+
+    native = noise_from_mean(msample, nsamples, sr, cutoff, lfnl=3., seed=0, dtype=np.float64)
+    # skip the initial transient of lfilter
+    reference = pymvpa_noise(msample, nsamples + 100, sr, cutoff, lfnl=3.)[100:]
+
+    # noise level in percent of the mean signal
+    native_level = np.mean(native.std(axis=0) / msample) * 100
+    reference_level = np.mean(reference.std(axis=0) / msample) * 100
+    assert abs(native_level - reference_level) / reference_level < .05
+    assert abs(lag1_autocorrelation(native) - lag1_autocorrelation(reference)) < .03
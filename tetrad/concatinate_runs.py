@@ -1,37 +1,178 @@
 #!/usr/bin/env python
 """
-Concatinate run-specific csv files
+Concatinate run-specific csv files (incrementally, see concat), or merge
+per-subject HDF5 stores of roi time series (written by meants_tetrad.py with
+--store) into one store.
+
+The stores hold one float32 DataFrame (time points x rois) per run under the
+key '/<sub>/<run>'. The merged store additionally holds the concatinated runs
+of each subject under '/concatinated/<sub>', so that load_store can read all
+subjects for IMaGES without any text parsing.
 """
 
-import pandas as pd
+import json
+import numpy as np
 import os
+import re
 from os.path import join
 
 
-def concat(base_dir):
+def discover_runs(base_dir):
+    """
+    Find the run-specific csv files in base_dir (base_dir/<run>/<sub>_<run>.csv).
+    Returns a dict {sub: [csv files, sorted by run]}.
+    """
+    runfiles = {}
+    for run in sorted(os.listdir(base_dir)):
+        rundir = join(base_dir, run)
+        if not re.match(r'^run\d+$', run) or not os.path.isdir(rundir):
+            continue
+        for fname in os.listdir(rundir):
+            match = re.match(r'^(.+)_%s\.csv$' % run, fname)
+            if match:
+                runfiles.setdefault(match.group(1), []).append(join(rundir, fname))
+    return runfiles
+
+
+def file_signature(files):
+    """
+    (file name, modification time, size) of each file, to tell whether the
+    inputs of a subject changed since its last concatination.
+    """
+    return [[os.path.basename(f), os.path.getmtime(f), os.path.getsize(f)] for f in files]
+
+
+def concat_files(files, outfile):
+    """
+    Append the csv files (with identical headers) line by line to outfile,
+    with a running 'idx' column in front (as pandas' to_csv with index_label='idx').
+    """
+    tmpfile = outfile + '.tmp%d' % os.getpid()
+    idx = 0
+    with open(tmpfile, 'w') as out:
+        header = None
+        for f in files:
+            with open(f, 'r') as infile:
+                run_header = infile.readline().rstrip('\r\n')
+                if header is None:
+                    header = run_header
+                    out.write('idx,%s\n' % header)
+                assert run_header == header, 'header of %s differs from first run' % f
+                for line in infile:
+                    line = line.rstrip('\r\n')
+                    if line:
+                        out.write('%d,%s\n' % (idx, line))
+                        idx += 1
+    os.rename(tmpfile, outfile)
 
-    subs = ['sub%03d' % i for i in xrange(1, 34)]
-    runs = ['run%03d' % i for i in xrange(1, 12)]
+
+def concat(base_dir, subs=None):
+    """
+    Concatinate the runs of each subject found in base_dir (or only the given
+    subjects) to base_dir/concatinated/<sub>.csv.
+    Incremental: a manifest (concatinated/manifest.json) records the input
+    files of each subject, and subjects whose inputs didn't change since are
+    skipped without reading any of their files.
+    """
+
+    outdir = join(base_dir, 'concatinated')
+    manifest_file = join(outdir, 'manifest.json')
 
     # make an output directory
-    if not os.path.exists(join(base_dir, 'concatinated')):
-        os.makedirs(join(base_dir, 'concatinated'))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+
+    runfiles = discover_runs(base_dir)
+    if subs is None:
+        subs = sorted(runfiles)
 
     for sub in subs:
-        files = [join(base_dir, run, '%s_%s.csv' % (sub, run)) for run in runs]
-        df_list = [pd.read_csv(f) for f in files]
-        full_df = pd.concat(df_list)
-        full_df.reset_index(inplace=True, drop=True)
+        files = runfiles.get(sub, [])
+        if not files:
+            print('no runs found for %s' % sub)
+            continue
+        signature = file_signature(files)
         outfilename = '%s.csv' % sub
 
-        if not os.path.exists(join(base_dir, 'concatinated', outfilename)):
-            full_df.to_csv(join(base_dir, 'concatinated', outfilename),
-                           index_label='idx')
-            print('successfully written out file for %s' % sub)
-        else:
-            print('%s already exists and was not overwritten' % outfilename)
+        if os.path.exists(join(outdir, outfilename)) and manifest.get(sub) == signature:
+            print('%s is up to date' % outfilename)
+            continue
+
+        concat_files(files, join(outdir, outfilename))
+        print('successfully written out file for %s (%d runs)' % (sub, len(files)))
+
+        # update manifest after every subject, so that an interrupted
+        # call doesn't have to redo the finished ones
+        manifest[sub] = signature
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def write_store_run(timeseries, storefile, sub, run, header):
+    """
+    Write the roi time series (time points x rois) of one run to the HDF5
+    store storefile under the key '/<sub>/<run>', with float32 columns named
+    after the rois.
+    """
+    import pandas as pd
+    df = pd.DataFrame(np.asarray(timeseries, dtype=np.float32), columns=header)
+    with pd.HDFStore(storefile, mode='a') as store:
+        store.put('/%s/%s' % (sub, run), df, format='fixed')
+
+
+def merge_stores(storefiles, outfile, complevel=0):
+    """
+    Merge per-subject stores into one store with the same '/<sub>/<run>' keys,
+    plus the runs of each subject concatinated (index 0..n-1, like the 'idx'
+    column of concat's csv files) under '/concatinated/<sub>'.
+    """
+    import pandas as pd
+    tmpfile = outfile + '.tmp%d' % os.getpid()
+    with pd.HDFStore(tmpfile, mode='w', complevel=complevel, complib='blosc') as out:
+        for storefile in storefiles:
+            with pd.HDFStore(storefile, mode='r') as store:
+                runs = {}
+                for key in sorted(store.keys()):
+                    sub, run = key.strip('/').split('/')
+                    runs.setdefault(sub, []).append(store[key])
+                    out.put(key, runs[sub][-1], format='fixed')
+            for sub, df_list in runs.items():
+                out.put('/concatinated/%s' % sub, pd.concat(df_list, ignore_index=True), format='fixed')
+                print('merged %d runs of %s' % (len(df_list), sub))
+    os.rename(tmpfile, outfile)
+
+
+def load_store(storefile, subs=None):
+    """
+    Load the concatinated roi time series of all (or the given) subjects from
+    a store written by merge_stores. Returns a dict {sub: DataFrame}.
+    """
+    import pandas as pd
+    with pd.HDFStore(storefile, mode='r') as store:
+        if subs is None:
+            subs = sorted(key.split('/')[-1] for key in store.keys()
+                          if key.startswith('/concatinated/'))
+        return dict((sub, store['/concatinated/%s' % sub]) for sub in subs)
 
 
 if __name__ == '__main__':
 
-    concat('/data/famface/openfmri/oli/results/extract_meants/csv')
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description='Concatinate the runs of each subject.')
+    parser.add_argument('base_dir', nargs='?', default='/data/famface/openfmri/oli/results/extract_meants/csv',
+                        help='directory with run-specific csv files')
+    parser.add_argument('--stores', nargs='+',
+                        help='merge these per-subject HDF5 stores instead of reading csv files')
+    parser.add_argument('--out', help='output file for the merged store (default: <base_dir>/roi_timeseries.h5)')
+    args = parser.parse_args()
+
+    if args.stores:
+        merge_stores(args.stores, args.out or join(args.base_dir, 'roi_timeseries.h5'))
+    else:
+        concat(args.base_dir)
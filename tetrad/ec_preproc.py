@@ -2,12 +2,11 @@
 """
 Pre-processing script for effective connectivity analysis.
 Contains functions to read files containing info about motion parameters, artifacts, and noise estimates
-from GLM preprocessing pipeline, construct regressors from them, apply a respective GLM with PyMVPA function
+from GLM preprocessing pipeline, construct regressors from them, fit them with an ordinary least squares GLM
 and save the residuals to nifti files.
 """
 
-from mvpa2.datasets.eventrelated import fit_event_hrf_model
-from mvpa2.datasets.mri import fmri_dataset, map2nifti
+import nibabel as nb
 import numpy as np
 from os.path import join as pjoin
 import os
@@ -18,7 +17,7 @@ def get_nuisance_regressors(qa_dir, run_number, num_noise_comps=5):
     For specified functional run,
     read the files containing motion parameters, artifacts (i.e. motion outliers), and noise components
     from the results directory.
-    Return array containing these regressors to be used as input 'extra_regressors' for 'fit_event_hrf_model'.
+    Return array containing these regressors to be used as nuisance design in 'preproc_run'.
     """
     # motion parameters
     motion_file = pjoin(qa_dir, 'art', 'run%02d_norm.bold_dtype_mcf.txt' % run_number)
@@ -47,67 +46,72 @@ def get_nuisance_regressors(qa_dir, run_number, num_noise_comps=5):
     return extra_regressors
 
 
-def preproc_run(boldfile, outfile, qa_dir, runnumber):
+def load_run(boldfile, dtype=np.float32):
     """
-    Use PyMVPA's function 'fit_event_hrf_model' to create and fit a nuisance GLM to the preprocessed bold data.
-    Save the Residuals of that GLM as NIFTI files.
+    Load a 4D nifti file into a (x, y, z, time) array of the given dtype.
+    The file is read in one go: slicing the volumes of a .nii.gz one by one
+    decompresses the stream from the start for every volume.
     """
-    # load preprocessed and transformed bold file
-    ds = fmri_dataset(boldfile)
+    img = nb.load(boldfile)
+    data = np.asarray(img.dataobj, dtype=dtype)
+    return img, data
 
-    # create dummy event. 'events' should contain dicts with name, onset, duration.
-    events = [{'condition': 'dummy',
-               'onset': [308],  # chose last time point to nullify effect of regressor
-               'duration': [0]}]
 
-    # get nuisance regressors
-    extra_regressors = get_nuisance_regressors(qa_dir, runnumber)
+def residualize(data, design, chunksize=10000):
+    """
+    Replace (in place) the voxel time series in data (voxels x time) with the
+    residuals of an OLS fit of design (time x regressors).
+    Voxels are processed in chunks (in float64) to keep memory bounded.
+    Like nipy's OLS model, the pseudo-inverse of the design is used, so rank
+    deficient designs (e.g. empty regressors) are handled the same way.
+    """
+    pinv_design = np.linalg.pinv(design)
 
-    # perform GLM
-    hrf_estimates = fit_event_hrf_model(ds, events,
-                                        design_kwargs=dict(hrf_model='canonical',
-                                                           drift_model='blank',
-                                                           add_regs=extra_regressors),
-                                        return_model=True, time_attr='time_coords',
-                                        condition_attr='condition', glmfit_kwargs=dict(model='ols'))
+    # voxels outside the brain are all zero and stay zero
+    brain = np.flatnonzero(np.abs(data).max(axis=1) > 0)
 
-    # get residuals from model. replace data in existing pymvpa dataset to maintain mapper
-    residuals4d_array = hrf_estimates.a.model.results_[0].resid
-    ds.samples = residuals4d_array
+    for start in range(0, len(brain), chunksize):
+        voxels = brain[start:start + chunksize]
+        y = data[voxels].T.astype(float)
+        data[voxels] = (y - np.dot(design, np.dot(pinv_design, y))).T
+    return data
 
-    # save to nifti
-    def _save_ds(d, fname):
-        """
-        Save pymvpa data set to nifti file
-        Requires data set to have a mapper
-        """
-        image = map2nifti(d)
-        image.to_filename(fname)
 
-    _save_ds(ds, outfile)
+def preproc_run(boldfile, outfile, qa_dir, runnumber, chunksize=10000):
+    """
+    Fit a nuisance GLM (motion parameters, artifacts, noise components and a
+    constant) to the preprocessed bold data with ordinary least squares.
+    Save the Residuals of that GLM as NIFTI files (float32).
 
+    This gives the same residuals as PyMVPA's 'fit_event_hrf_model' with a
+    dummy event after the last volume and a 'blank' drift model, but without
+    building an event-related design and a results object for every voxel.
+    """
+    # load preprocessed and transformed bold file
+    img, data = load_run(boldfile)
 
-if __name__ == '__main__':
+    # get nuisance regressors and add the constant of the 'blank' drift model
+    extra_regressors = get_nuisance_regressors(qa_dir, runnumber)
+    design = np.column_stack((extra_regressors, np.ones(len(extra_regressors))))
 
-    import sys
-    sub_nr = int(sys.argv[1])    # subject number as integer
+    # perform GLM on the voxels x time view of the data
+    residualize(data.reshape(-1, data.shape[3]), design, chunksize=chunksize)
+
+    # save to nifti
+    residual_img = nb.Nifti1Image(data, img.affine, img.header)
+    residual_img.set_data_dtype(np.float32)
+    residual_img.to_filename(outfile)
 
-    # I/O paths
-    results_basedir = '/data/famface/openfmri/oli/results/results_with_main_effects/' \
-                      'l1ants_fwhm6_hp60_derivs_frac0.1/l1ants_fwhm6_hp60_derivs_frac0.1/' \
-                      'model001/task001/'
-    qadir = pjoin(results_basedir, 'sub%03d' % sub_nr, 'qa')
-    out_dir = pjoin('/data/famface/openfmri/oli/results/ec_preproc/', 'sub%03d' % sub_nr, 'residual4d', 'mni')
 
-    # check if out dir exists
+def preproc_subject(results_basedir, sub_nr, out_dir, run_nrs=range(1, 12)):
+    """
+    Run preproc_run for all runs of one subject in a single process.
+    """
+    qadir = pjoin(results_basedir, 'sub%03d' % sub_nr, 'qa')
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-    else:
-        print('Output directory: %s ' % out_dir)
-        raise(OSError, 'Sorry Master. Output directory already exists.')
 
-    # iterate over runs
-    for run_nr in range(1, 12):
+    for run_nr in run_nrs:
         # I/O files
         bold_file = pjoin(results_basedir, 'sub%03d' % sub_nr, 'bold', 'run%03d' % run_nr, 'bold_mni.nii.gz')
         out_file = pjoin(out_dir, 'res4d_run%02d.nii.gz' % run_nr)
@@ -115,3 +119,34 @@ if __name__ == '__main__':
         preproc_run(bold_file, out_file, qadir, run_nr)
         # report back to me
         print('finished run %03d subject %03d' % (run_nr, sub_nr))
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import sys
+    from os.path import abspath, dirname
+    sys.path.insert(0, pjoin(dirname(abspath(__file__)), '..', 'analysis'))
+    from scheduler import WorkItem, expand_subjects, add_scheduler_arguments, run_work_items
+
+    parser = argparse.ArgumentParser(description='Residualize nuisance regressors from the bold runs of '
+                                                 'one or more subjects (one work item per subject).')
+    parser.add_argument('subjects', help='subject number(s), e.g. 1, 1,4 or 1-33')
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+
+    # I/O paths
+    results_basedir = '/data/famface/openfmri/oli/results/results_with_main_effects/' \
+                      'l1ants_fwhm6_hp60_derivs_frac0.1/l1ants_fwhm6_hp60_derivs_frac0.1/' \
+                      'model001/task001/'
+
+    items = []
+    for sub_nr in [int(sub) for sub in expand_subjects(args.subjects)]:
+        out_dir = pjoin('/data/famface/openfmri/oli/results/ec_preproc/', 'sub%03d' % sub_nr, 'residual4d', 'mni')
+        items.append(WorkItem(name='sub%03d' % sub_nr, func=preproc_subject,
+                              kwargs=dict(results_basedir=results_basedir, sub_nr=sub_nr, out_dir=out_dir),
+                              outputs=[pjoin(out_dir, 'res4d_run%02d.nii.gz' % run_nr) for run_nr in range(1, 12)]))
+
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+    sys.exit(1 if failed else 0)
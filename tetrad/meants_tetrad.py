@@ -1,13 +1,13 @@
 #!/usr/bin/env python
 
 from mvpa2.datasets.mri import fmri_dataset
-from mvpa2.misc.data_generators import simple_hrf_dataset
 from nipype.interfaces import fsl, ants
 from nipype.interfaces.fsl.utils import ConvertXFM
 from nipype.interfaces.c3 import C3dAffineTool
 import numpy as np
 import csv
 import os
+import sys
 from os.path import join
 
 """
@@ -15,27 +15,27 @@ Tools to extract mean timeseries or beta values from 4D or 3D statistical images
 given ROI masks in standard space. 
 """
 
+# the simulation functions (onsets and hrf models for add_contrast)
+simulation_dir = join(os.path.dirname(os.path.abspath(__file__)), '..', 'simulation')
+if simulation_dir not in sys.path:
+    sys.path.insert(0, simulation_dir)
+
+# the shared analysis modules (roi reduction, scheduler)
+analysis_dir = join(os.path.dirname(os.path.abspath(__file__)), '..', 'analysis')
+if analysis_dir not in sys.path:
+    sys.path.insert(0, analysis_dir)
+from roi_extract import load_roi_block, roi_means
+
 
 def extract_mean_timeseries(bold, mask):
     """
     extract mean time series of rois given pymvpa datasets
     for a mask and a bold time-series. Used for TETRAD.
+    Returns a (time points x rois) array.
     """
 
-    roi_timeseries = []
-
     # select first sample of mask dataset
-    roi = mask.samples[0]
-
-    # make a copy of bold dataset for safety
-    bold_cp = bold.copy()
-
-    for roi_value in range(1, int(max(roi)) + 1):
-        roi_timeseries.append(
-            [np.mean(sample[roi == roi_value]) for sample in bold_cp.samples]
-        )
-
-    return roi_timeseries
+    return roi_means(bold.samples, mask.samples[0])
 
 
 def add_contrast(timeseries, onsetpath, amplitudes=(1, 1)):
@@ -47,35 +47,23 @@ def add_contrast(timeseries, onsetpath, amplitudes=(1, 1)):
     our connectivity model in Py-Causal / TETRAD.
     """
 
-    # import custom function, used also during simulation, to get the onsets
-
-    sys.path.insert(0, '/data/famface/openfmri/oli/osf_prereg_code/simulation')
-    from famface_simulation_functions import get_onsets_famface
+    # import custom functions, used also during simulation, to get the onsets
+    # and (cached) hrf models
+    from famface_simulation_functions import get_onsets_famface, hrf_regressor
 
     # get onsets
     spec = get_onsets_famface(onsetpath, amplitudes)
 
     # construct hrf model for familiar and unfamiliar faces
-    # (in the form of dicts in a list)
-    hrf_models = []
-    for condition, amplitude in zip(spec, amplitudes):
-        hrf_model = simple_hrf_dataset(events=condition['onset'],
-                                       nsamples=154,
-                                       tr=2,
-                                       tres=2,
-                                       baseline=0,
-                                       signal_level=amplitude,
-                                       noise_level=0)
-        hrf_models.append(hrf_model)
+    hrf_models = [hrf_regressor(condition['onset'], tr=2, nsamples=154, tres=2,
+                                baseline=0, signal_level=amplitude)
+                  for condition, amplitude in zip(spec, amplitudes)]
 
     # subtract
-    fam_vs_unfam = hrf_models[0].samples[:, 0] - hrf_models[1].samples[:, 0]
+    fam_vs_unfam = hrf_models[0] - hrf_models[1]
 
-    # append to time series
-    from copy import deepcopy
-    ts_copy = deepcopy(timeseries)
-    ts_copy.append(fam_vs_unfam)
-    return ts_copy
+    # append to time series as additional column
+    return np.column_stack((timeseries, fam_vs_unfam))
 
 
 def getlabels(csvpath):
@@ -93,30 +81,80 @@ def getlabels(csvpath):
 
 def transpose_and_write(roi_timeseries, outfile, header):
     """
-    Write roi_timeseries to csv file (with roi-indices as header) with rois as
-    columns and time points as rows.
+    Write roi_timeseries (time points x rois, as returned by
+    extract_mean_timeseries) to csv file (with roi labels as header) with rois
+    as columns and time points as rows.
     For use in TETRAD.
     """
-    transposed = map(list, zip(*roi_timeseries))
-    assert len(header) == len(transposed[0])
-    transposed.insert(0, header)
+    roi_timeseries = np.asarray(roi_timeseries)
+    assert len(header) == roi_timeseries.shape[1]
 
     # TODO: See if py-causal can deal with scientific notation for very small and large numbers.
     # if not, tell csv to write in regular floats
     with open(outfile, 'w') as f:
         wr = csv.writer(f)
-        wr.writerows(transposed)
+        wr.writerow(header)
+        wr.writerows(roi_timeseries.tolist())
+
+
+def write_run(timeseries, out_dir, sub_id, run, header, storefile=None):
+    """
+    Write the time series of one run, either to csv (out_dir/csv/<run>/<sub>_<run>.csv)
+    or, if storefile is given, to an HDF5 store (see concatinate_runs.write_store_run).
+    """
+    if storefile is not None:
+        # pandas/pytables are only needed for the store backend
+        from concatinate_runs import write_store_run
+        write_store_run(timeseries, storefile, sub_id, run, header)
+        return
+
+    # create output dir
+    if not os.path.exists(join(out_dir, 'csv', run)):
+        os.makedirs(join(out_dir, 'csv', run))
+    transpose_and_write(timeseries, join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run)), header)
+
+
+def store_path(out_dir, sub_id):
+    """
+    path of the HDF5 store holding all runs of a subject
+    """
+    return join(out_dir, '{}_roi_timeseries.h5'.format(sub_id))
+
+
+def open_store(out_dir, sub_id):
+    """
+    Return the path of a temporary store for the runs of a subject, which is
+    moved to store_path by close_store once all runs are written (so that an
+    interrupted job doesn't leave an incomplete store behind).
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    tmpfile = store_path(out_dir, sub_id) + '.tmp%d' % os.getpid()
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    return tmpfile
+
+
+def close_store(tmpfile, out_dir, sub_id):
+    os.rename(tmpfile, store_path(out_dir, sub_id))
 
 
 def extract_runs_famface_mnimask(base_dir, out_dir, mnimask, sub_id,
                                  with_contrast=False,
-                                 labelcsv='/data/famface/openfmri/github/notebooks/roi_coord.csv'):
+                                 labelcsv='/data/famface/openfmri/github/notebooks/roi_coord.csv',
+                                 lazy=False, cache_dir=None, runs=None, store=False):
     """
-    Given our famface data, extract time series for ALL runs of ONE subject.
+    Given our famface data, extract time series for ALL runs of ONE subject
+    (or only the given runs).
     For use in TETRAD. base_dir contains pre-processed BOLD images in mni space.
+    If lazy, only the voxels within the rois' bounding box are read
+    (see load_roi_block).
+    If store, all runs are written to one HDF5 store (see store_path) instead
+    of one csv file per run.
     """
 
-    runs = ['run%03d' % i for i in xrange(1, 12)]
+    if runs is None:
+        runs = ['run%03d' % i for i in range(1, 12)]
 
     # enumerated label names from csv file
     labels = getlabels(labelcsv)
@@ -128,44 +166,48 @@ def extract_runs_famface_mnimask(base_dir, out_dir, mnimask, sub_id,
         header.append('FAM-UNFAM')
 
     # load mask in pymvpa
-    ms = fmri_dataset(mnimask)
+    if not lazy:
+        ms = fmri_dataset(mnimask)
+
+    storefile = open_store(out_dir, sub_id) if store else None
 
     for run in runs:
-        # create output dir
-        if not os.path.exists(join(out_dir, 'csv', run)):
-            os.makedirs(join(out_dir, 'csv', run))
         infile = join(base_dir, sub_id, 'bold', run, 'bold_mni.nii.gz')
-        # load bold file in pymvpa
-        bold = fmri_dataset(infile)
-        # extract time series
-        timeseries = extract_mean_timeseries(bold, ms)
+        if lazy:
+            # only read the roi voxels
+            samples, roi = load_roi_block(infile, mnimask, cache_dir)
+            timeseries = roi_means(samples, roi)
+        else:
+            # load bold file in pymvpa
+            bold = fmri_dataset(infile)
+            # extract time series
+            timeseries = extract_mean_timeseries(bold, ms)
 
         if with_contrast:
             # TODO: don't hardcode data directory
             data_dir = '/data/famface/openfmri/oli/simulation/data_oli'
             onsetpath = join(data_dir, sub_id, 'model', 'model001', 'onsets', 'task001_%s' % run)
-            ts_with_contrast = add_contrast(timeseries, onsetpath)
+            timeseries = add_contrast(timeseries, onsetpath)
 
-            # write to csv
-            outfile = join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run))
-            transpose_and_write(ts_with_contrast, outfile, header)
+        # write to csv (or store)
+        write_run(timeseries, out_dir, sub_id, run, header, storefile)
 
-        else:
-            # write to csv
-            outfile = join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run))
-            transpose_and_write(timeseries, outfile, header)
+    if store:
+        close_store(storefile, out_dir, sub_id)
 
 
 def extract_runs_nuisancedata(base_dir, out_dir, mnimask, sub_id,
                               with_contrast=False,
-                              labelcsv='/data/famface/openfmri/github/notebooks/roi_coord.csv'):
+                              labelcsv='/data/famface/openfmri/github/notebooks/roi_coord.csv',
+                              lazy=False, cache_dir=None, runs=None, store=False):
     """
     extract time series from the residuals of our nuisance model.
     This does essentially the same as extract_runs_famface_mnimask, only
     for different input path structure.
     """
     """
-    Given our famface data, extract time series for ALL runs of ONE subject.
+    Given our famface data, extract time series for ALL runs of ONE subject
+    (or only the given runs).
     For use in TETRAD. base_dir contains pre-processed BOLD images in mni space.
     """
 
@@ -178,17 +220,21 @@ def extract_runs_nuisancedata(base_dir, out_dir, mnimask, sub_id,
     if with_contrast:
         header.append('FAM-UNFAM')
 
-    ms = fmri_dataset(mnimask)
+    if not lazy:
+        ms = fmri_dataset(mnimask)
 
-    runs = ['run%02d' % i for i in xrange(1, 12)]
-    for run in runs:
-        # create output dir
-        if not os.path.exists(join(out_dir, 'csv', run)):
-            os.makedirs(join(out_dir, 'csv', run))
+    if runs is None:
+        runs = ['run%02d' % i for i in range(1, 12)]
+    storefile = open_store(out_dir, sub_id) if store else None
 
+    for run in runs:
         infile = join(base_dir, sub_id, 'residual4d', 'mni', 'res4d_%s.nii.gz' % run)
-        bold = fmri_dataset(infile)
-        timeseries = extract_mean_timeseries(bold, ms)
+        if lazy:
+            samples, roi = load_roi_block(infile, mnimask, cache_dir)
+            timeseries = roi_means(samples, roi)
+        else:
+            bold = fmri_dataset(infile)
+            timeseries = extract_mean_timeseries(bold, ms)
 
         if with_contrast:
             # TODO: don't hardcode data directory
@@ -196,16 +242,13 @@ def extract_runs_nuisancedata(base_dir, out_dir, mnimask, sub_id,
             runstring = run[:3] + '0' + run[3:]
             onsetpath = join(data_dir, sub_id, 'model/model001/onsets', 'task001_%s' % runstring)
 
-            ts_with_contrast = add_contrast(timeseries, onsetpath)
+            timeseries = add_contrast(timeseries, onsetpath)
 
-            # write to csv
-            outfile = join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run))
-            transpose_and_write(ts_with_contrast, outfile, header)
+        # write to csv (or store)
+        write_run(timeseries, out_dir, sub_id, run, header, storefile)
 
-        else:
-            # write to csv
-            outfile = join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run))
-            transpose_and_write(timeseries, outfile, header)
+    if store:
+        close_store(storefile, out_dir, sub_id)
 
 
 if __name__ == '__main__':
@@ -213,32 +256,66 @@ if __name__ == '__main__':
     """
     get command line arguments
     """
+    import argparse
     import sys
 
-    sub_id = sys.argv[1]
-    mnimask = sys.argv[2]
-    base_dir = sys.argv[3]
-
-    # subject specific output directory
-    out_base_dir = sys.argv[4]
-    out_dir = join(out_base_dir, sub_id)
+    # shared scheduler for running many subjects/runs in a local process pool
+    from scheduler import WorkItem, add_scheduler_arguments, expand_subjects, run_work_items
 
+    parser = argparse.ArgumentParser(description='Extract mean roi time series for TETRAD.')
+    parser.add_argument('sub_id',
+                        help="subject(s), e.g. 'sub001', 'sub001,sub004' or 'sub001-sub033'")
+    parser.add_argument('mnimask')
+    parser.add_argument('base_dir')
+    # subject specific output directories are created in here
+    parser.add_argument('out_base_dir')
     # if residuals should be used, the run script gives the argument 'residuals'
     # at this position
-    residual_string = sys.argv[5]
-
+    parser.add_argument('residual_string')
     # if the contrast between familiar and unfamiliar should be included,
     # this should be 'with_contrast'
-    contrast_string = sys.argv[6]
-    if contrast_string == 'with_contrast':
-        contrast = True
+    parser.add_argument('contrast_string')
+    # optional: directory for uncompressed copies of the bold files.
+    # if given, only the roi voxels are read (memory mapped) from these copies.
+    parser.add_argument('cache_dir', nargs='?', default=None)
+    parser.add_argument('--store', action='store_true',
+                        help='write all runs of a subject to one HDF5 store '
+                             '(out_base_dir/<sub>/<sub>_roi_timeseries.h5) instead of csv files')
+    add_scheduler_arguments(parser)
+    args = parser.parse_args()
+
+    contrast = args.contrast_string == 'with_contrast'
+    lazy = args.cache_dir is not None
+
+    if args.residual_string == 'residuals':
+        extract_func = extract_runs_nuisancedata
+        runs = ['run%02d' % i for i in range(1, 12)]
     else:
-        contrast = False
+        extract_func = extract_runs_famface_mnimask
+        runs = ['run%03d' % i for i in range(1, 12)]
 
     """
-    run the executing function
+    run the executing function, one work item per subject and run
+    (or per subject with --store, so that each store has a single writer)
     """
-    if residual_string == 'residuals':
-        extract_runs_nuisancedata(base_dir, out_dir, mnimask, sub_id, with_contrast=contrast)
-    else:
-        extract_runs_famface_mnimask(base_dir, out_dir, mnimask, sub_id, with_contrast=contrast)
+    items = []
+    for sub_id in expand_subjects(args.sub_id):
+        out_dir = join(args.out_base_dir, sub_id)
+        kwargs = dict(base_dir=args.base_dir, out_dir=out_dir, mnimask=args.mnimask,
+                      sub_id=sub_id, with_contrast=contrast,
+                      lazy=lazy, cache_dir=args.cache_dir)
+        if args.store:
+            items.append(WorkItem(name=sub_id, func=extract_func,
+                                  kwargs=dict(kwargs, runs=runs, store=True),
+                                  outputs=[store_path(out_dir, sub_id)]))
+            continue
+        for run in runs:
+            items.append(WorkItem(
+                name='{} {}'.format(sub_id, run),
+                func=extract_func,
+                kwargs=dict(kwargs, runs=[run]),
+                outputs=[join(out_dir, 'csv', run, '{}_{}.csv'.format(sub_id, run))]))
+
+    failed = run_work_items(items, n_workers=args.n_workers, retries=args.retries,
+                            skip_existing=not args.overwrite)
+    sys.exit(1 if failed else 0)